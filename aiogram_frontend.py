@@ -5,34 +5,153 @@
 from datetime import datetime, timedelta
 
 import asyncio
+import io
 import logging
 import os
+import tempfile
+import threading
+import time
 
 # package modules
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.filters import CommandObject, CommandStart, Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from dotenv import load_dotenv
 
 # custom modules
+import aiogram_storage
+import aiogram_webhook
 import remind
+import remind_io
 
 # ----------------------------------------------------------------------------
 # global variables
 load_dotenv()
 
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-dp = Dispatcher()
+bot = aiogram_webhook.make_bot()
 
-scheduler = AsyncIOScheduler()
-reminders = []
-job_ids = []
+# conversation state is kept per chat and user in the storage given by
+# REMIND_FSM_STORAGE (see aiogram_storage.make_storage). prompts that aren't
+# answered within REMIND_PROMPT_TTL seconds are forgotten.
+PROMPT_TTL = float(os.getenv("REMIND_PROMPT_TTL", "600"))
+dp = Dispatcher(storage=aiogram_storage.make_storage(os.getenv("REMIND_FSM_STORAGE", "memory"), PROMPT_TTL))
 
-waiting_for_prompt = False
-reminder_time = None
-reminder_interval = []
+# if REMIND_SCHEDULER is "native", reminders are scheduled with remind's own
+# scheduler instead of APScheduler. REMIND_SLACK sets how many seconds late
+# it may fire reminders to group them into fewer wakeups.
+if os.getenv("REMIND_SCHEDULER") == "native":
+    scheduler = remind.AsyncioReminderScheduler(slack=float(os.getenv("REMIND_SLACK", "0")))
+else:
+    scheduler = AsyncIOScheduler()
+
+# if REMIND_DB is set, reminders are kept in an SQLite database at that path
+# and restored on startup.
+#
+# if REMIND_SPREAD is set, every new reminder goes off up to that many
+# seconds late (always the same amount for the same reminder, see
+# remind.jitterfor), so reminders set for the same time don't all go off
+# in the same second.
+REMIND_DB = os.getenv("REMIND_DB")
+SPREAD = float(os.getenv("REMIND_SPREAD", "0"))
+if REMIND_DB:
+    reminders = remind.SQLiteReminderStore(REMIND_DB, spread=SPREAD)
+else:
+    reminders = remind.ReminderStore(SPREAD)
+
+# restored reminders are only scheduled once they are due within this many
+# seconds, so restoring lots of them doesn't create a job for each at once.
+RESTORE_HORIZON = 60
+restored_until = float("-inf")
+
+# fired reminders are sent through a queue that keeps us under Telegram's
+# flood limits: REMIND_SEND_RATE messages per second in total and
+# REMIND_CHAT_RATE per chat, with reminders for the same chat that fire
+# within REMIND_MERGE_WINDOW seconds of each other merged into one message.
+async def send_reminder(chat_id: int, text: str, reply_to: int):
+    reply = None
+    if reply_to is not None:
+        reply = types.ReplyParameters(message_id=reply_to, allow_sending_without_reply=True)
+    await bot.send_message(chat_id, text, reply_parameters=reply)
+
+# retry on flood control, network and server errors, give up on anything
+# else (e.g the bot was blocked)
+def retry_delay(e: Exception, attempt: int):
+    if isinstance(e, TelegramRetryAfter):
+        return e.retry_after
+    elif isinstance(e, (TelegramNetworkError, TelegramServerError)):
+        return remind.default_retry_delay(e, attempt)
+    return None
+
+delivery = remind.DeliveryQueue(send_reminder,
+                                rate=float(os.getenv("REMIND_SEND_RATE", "30")),
+                                chat_rate=float(os.getenv("REMIND_CHAT_RATE", "1")),
+                                window=float(os.getenv("REMIND_MERGE_WINDOW", "1")),
+                                workers=int(os.getenv("REMIND_SEND_WORKERS", "8")),
+                                retry_delay=retry_delay)
+
+# reminders that should have gone off while we weren't running are handled
+# according to REMIND_MISFIRE ("once", "all", "skip" or "coalesce", see
+# remind.CatchUp), or REMIND_MISFIRE_REPEATING for repeating reminders, at
+# most REMIND_CATCHUP_RATE per second, so the backlog doesn't crowd out the
+# reminders that go off on time.
+CATCHUP_RATE = int(os.getenv("REMIND_CATCHUP_RATE", "10"))
+catchup = remind.CatchUp(reminders,
+                         lambda rem: delivery.put(rem.owner, f"REMINDER - {rem.message}", rem.reply_to),
+                         lambda owner, text: delivery.put(owner, text),
+                         os.getenv("REMIND_MISFIRE", "once"), os.getenv("REMIND_MISFIRE_REPEATING"))
+catchup_job = None
+
+# limits on new reminders, see remind.Quotas: a chat may have at most
+# REMIND_MAX_REMINDERS reminders, that repeat at most every REMIND_MIN_INTERVAL
+# seconds, and set REMIND_CREATE_RATE per minute, in bursts of
+# REMIND_CREATE_BURST. 0 means no limit. while more than REMIND_MAX_BACKLOG
+# reminders are waiting to be sent, new reminders are refused, or with
+# REMIND_BACKPRESSURE=defer, accepted but only scheduled once the backlog is
+# down again.
+quotas = remind.Quotas(reminders,
+                       max_reminders=int(os.getenv("REMIND_MAX_REMINDERS", "0")),
+                       min_interval=float(os.getenv("REMIND_MIN_INTERVAL", "0")),
+                       create_rate=float(os.getenv("REMIND_CREATE_RATE", "0")) / 60,
+                       create_burst=float(os.getenv("REMIND_CREATE_BURST", "0")),
+                       backlog=lambda: len(delivery) + len(firecap) + len(catchup),
+                       max_backlog=int(os.getenv("REMIND_MAX_BACKLOG", "0")),
+                       mode=os.getenv("REMIND_BACKPRESSURE", "reject"))
+
+# metrics, shown to the users in REMIND_ADMINS (a comma-separated list of user
+# IDs) by /stats. if REMIND_METRICS_PORT is set, they are also served in the
+# Prometheus text format at http://127.0.0.1:<port>/metrics.
+ADMINS = {int(user_id) for user_id in os.getenv("REMIND_ADMINS", "").split(",") if user_id.strip()}
+
+remind.metrics.gauge("pending_reminders", reminders.counts)
+remind.metrics.gauge("delivery_queue", delivery.__len__)
+remind.metrics.gauge("missed_fires_pending", catchup.__len__)
+remind.metrics.gauge("deferred_reminders", quotas.__len__)
+if isinstance(scheduler, remind.ReminderScheduler):
+    remind.metrics.gauge("scheduler_timers", scheduler.__len__)
+
+# time every update's handling
+@dp.update.outer_middleware()
+async def measure_handler(handler, event, data):
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        remind.metrics.observe("handler_latency_seconds", time.perf_counter() - start)
+
+# ----------------------------------------------------------------------------
+# conversation states
+class ReminderPrompt(StatesGroup):
+    # waiting for the message of a reminder. the state data holds the
+    # reminder's "type" and its "next_fire" or "interval".
+    message = State()
+    # waiting for a file to import
+    import_file = State()
 
 # ----------------------------------------------------------------------------
 # basic commands like /start and /help
@@ -43,162 +162,518 @@ async def cmd_start(message: types.Message):
 @dp.message(Command("help"))
 async def cmd_help(message: types.Message):
     await message.answer("""available commands:
-    /list (aliases: /l /ls) -- list all currently active reminders
-    /remove <reminder ID> (aliases: /r /rm) -- remove an active reminder with the ID of <reminder ID>
+    /list [page] (aliases: /l /ls) -- list all currently active reminders
+    /remove <IDs> (aliases: /r /rm) -- remove the active reminders with the IDs in <IDs>, e.g '/rm 3 5 9-20'
+    /remove all -- remove all active reminders
+    /remove match <terms> -- remove the active reminders that /find <terms> lists
+    /find <terms> (aliases: /f) -- list the reminders with words starting with <terms>
     /remindafter <time> (aliases: /ra /remindin) -- set a reminder that will activate once an amount of time specified by <time> passes
     /remindat <datetime> (aliases: /rt /remind) -- set a reminder that will activate at the date and/or time specified by <datetime>
-    /remindevery <interval> (aliases: /re) -- set a reminder that will activate every time the amount of time specified by <interval> passes""")
+    /remindevery <interval> (aliases: /re) -- set a reminder that will activate every time the amount of time specified by <interval> passes
+    /import -- import reminders from a CSV, JSONL or iCalendar file
+    /export [csv|jsonl|ics] -- export your reminders to a file""")
 
 # ----------------------------------------------------------------------------
 # job management
 
-# get a job id.
-def get_job_id() -> int:
-    job_id = 0
-    while job_id in job_ids:
-        job_id += 1
-    job_ids.append(job_id)
-    return job_id
+# held while creating or cancelling a job. schedule_restored runs in another
+# thread and may see a reminder that was just added before its job was
+# created, so scheduling has to be atomic.
+schedule_lock = threading.Lock()
+
+# create the scheduler job of a reminder, unless it already has one or was
+# removed in the meantime.
+def schedule(rem: remind.Reminder):
+    with schedule_lock:
+        if rem.job is not None or reminders.get(rem.job_id) is not rem:
+            return
+        now = time.time()
+        if rem.interval is not None and shared_timers is not None:
+            rem.job = shared_timers.add(rem)
+        elif rem.interval is not None:
+            next_fire = remind.nextfire(rem.fire_at, rem.interval, now)
+            rem.job = scheduler.add_job(do_remind, "interval", args=[rem], seconds=rem.interval,
+                                        next_run_time=datetime.fromtimestamp(next_fire))
+        else:
+            # reminders that were due while we weren't running fire right away
+            run_date = datetime.fromtimestamp(max(rem.fire_at, now))
+            rem.job = scheduler.add_job(do_remind, "date", args=[rem], run_date=run_date)
+
+# schedule a reminder that was just set, unless it has to wait until the bot
+# isn't busy anymore.
+#
+# returns True if it has to wait.
+def schedule_new(rem: remind.Reminder) -> bool:
+    if quotas.defer(rem):
+        return True
+    schedule(rem)
+    return False
+
+# schedule the reminders that waited for the bot to not be busy, runs every
+# second with REMIND_BACKPRESSURE=defer.
+async def admit_deferred():
+    quotas.step(schedule)
+
+# restore the reminders from the database. the ones that should have gone
+# off while we weren't running are handed to catchup.
+def restore():
+    global restored_until, catchup_job
+    reminders.load()
+    now = time.time()
+    missed = reminders.due_between(float("-inf"), now)
+    catchup.add(missed, reminders.last_seen, now)
+    for rem in missed:
+        if rem.interval is not None:
+            schedule(rem)
+    restored_until = now
+    schedule_restored()
+    if len(catchup) > 0:
+        catchup_job = scheduler.add_job(catch_up, "interval", seconds=1)
+
+# handle the next missed fires, runs every second until they're all done.
+# this is a coroutine so APScheduler runs it in the event loop, where the
+# delivery queue lives.
+async def catch_up():
+    if catchup.step(CATCHUP_RATE) == 0:
+        catchup_job.remove()
+
+# schedule the restored reminders that are due soon. runs every
+# RESTORE_HORIZON / 2 seconds, each run only looks at the reminders that
+# became due since the last one.
+def schedule_restored():
+    global restored_until
+    end = time.time() + RESTORE_HORIZON
+    for rem in reminders.due_between(restored_until, end):
+        schedule(rem)
+    restored_until = end
+
+# cancel the scheduler job of a reminder, if it has one.
+def cancel(rem: remind.Reminder):
+    with schedule_lock:
+        job, rem.job = rem.job, None
+    if job is not None:
+        try:
+            job.remove()
+        except JobLookupError:
+            # it already went off
+            pass
 
 # remove a job by its job id.
 def remove_job_by_id(job_id: int):
-    for rem in reminders[:]:
-        if rem["job_id"] == job_id:
-            if rem["type"] == "repeating":
-                rem["job"].remove()
-            job_ids.remove(rem["job_id"])
-            reminders.remove(rem)
+    rem = reminders.remove(job_id)
+    if rem is not None:
+        cancel(rem)
+
+# remove many jobs by their job ids at once.
+#
+# returns the amount of removed jobs.
+def remove_jobs(job_ids: list) -> int:
+    removed = reminders.remove_many(job_ids)
+    for rem in removed:
+        cancel(rem)
+    return len(removed)
 
 # ----------------------------------------------------------------------------
-# print a reminder message - used by scheduled jobs
-async def do_remind(message: types.Message, job_id: int):
-    await message.answer(f"REMINDER - {message.text}")
-    if job_id >= 0:
-        remove_job_by_id(job_id)
+# queue a reminder message for sending, unless it was removed since it went
+# off
+def fire(rem: remind.Reminder):
+    if reminders.get(rem.job_id) is not rem:
+        return
+    now = time.time()
+    remind.metrics.observe("fire_lag_seconds", now - rem.due(now))
+    remind.metrics.inc("reminders_fired_total")
+    delivery.put(rem.owner, f"REMINDER - {rem.message}", rem.reply_to)
+    if rem.interval is None:
+        # the job is done, there's nothing to cancel
+        rem.job = None
+        remove_job_by_id(rem.job_id)
+
+# at most REMIND_MAX_FIRES reminders are fired per second, the rest are fired
+# in the next seconds (see remind.FireCap). 0 means no limit.
+firecap = remind.FireCap(fire, int(os.getenv("REMIND_MAX_FIRES", "0")))
+remind.metrics.gauge("fires_deferred", firecap.__len__)
+
+# the scheduled jobs. these are coroutines so APScheduler runs them in the
+# event loop, where the delivery queue lives.
+async def do_remind(rem: remind.Reminder):
+    firecap(rem)
+
+# the job of a group of repeating reminders that share one
+async def do_remind_group(group: remind.TimerGroup):
+    for rem in group:
+        firecap(rem)
+
+async def fire_deferred():
+    firecap.step()
+
+# repeating reminders with the same interval whose fires line up share one
+# scheduler job, see remind.SharedTimers. fires are lined up by rounding them
+# up to REMIND_TIMER_GRANULARITY seconds, so they go off up to that late. with
+# 0, every reminder gets its own job.
+TIMER_GRANULARITY = float(os.getenv("REMIND_TIMER_GRANULARITY", "1"))
+if TIMER_GRANULARITY > 0:
+    shared_timers = remind.SharedTimers(scheduler, do_remind_group, TIMER_GRANULARITY)
+    remind.metrics.gauge("timer_groups", shared_timers.__len__)
+else:
+    shared_timers = None
 
 # ----------------------------------------------------------------------------
 # the list command, used to list all active reminders
 # aliases: /l /ls /list
+#
+# reminders are listed LIST_PAGE_SIZE at a time, with buttons to go to the
+# previous and next page. a page is cut short if it wouldn't fit in one
+# message.
+LIST_PAGE_SIZE = 20
+
+# helper function used by cmd_list -- build the page of a chat's reminder list
+# that starts at the <offset>th reminder. only the reminders on the page (and
+# the one after it, to know if there is a next page) are looked at.
+#
+# returns the text and the keyboard of the page, or (None, None) if there are
+# no reminders at <offset>.
+def listpage(chat_id: int, offset: int) -> tuple:
+    lines = []
+    length = 0
+    more = False
+    for rem in reminders.iter_owner(chat_id, offset, limit=LIST_PAGE_SIZE + 1):
+        line = f"reminder with ID {rem.job_id} -- will go off {rem.timestr}, type: {rem.type}, message: '{rem.message}'"
+        line = line[:remind.MAX_MESSAGE_LENGTH]
+        if len(lines) == LIST_PAGE_SIZE or length + len(line) > remind.MAX_MESSAGE_LENGTH:
+            more = True
+            break
+        lines.append(line)
+        length += len(line) + 1
+    if not lines:
+        return None, None
+
+    buttons = []
+    if offset > 0:
+        buttons.append(types.InlineKeyboardButton(text="< prev", callback_data=f"list:{max(0, offset - LIST_PAGE_SIZE)}"))
+    if more:
+        buttons.append(types.InlineKeyboardButton(text="next >", callback_data=f"list:{offset + len(lines)}"))
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
 @dp.message(Command(commands=["l", "ls", "list"]))
 async def cmd_list(message: types.Message, command: CommandObject):
-    if len(reminders) == 0:
-        await message.answer("you don't have any active reminders right now.")
+    page = 1
+    if command.args:
+        if not command.args.isdigit() or int(command.args) < 1:
+            await message.answer("error: invalid page number")
+            return
+        page = int(command.args)
+    text, keyboard = listpage(message.chat.id, (page - 1) * LIST_PAGE_SIZE)
+    if text is None:
+        if page == 1:
+            await message.answer("you don't have any active reminders right now.")
+        else:
+            await message.answer("error: no such page")
     else:
-        answer = ""
-        for rem in reminders:
-            answer += f"reminder with ID {rem['job_id']} -- will go off {rem['timestr']}, type: {rem['type']}, message: '{rem['message']}'\n"
-        await message.answer(answer[:-1]) # strip unneeded final newline
+        await message.answer(text, reply_markup=keyboard)
+
+# the prev/next buttons of a list page
+@dp.callback_query(F.data.startswith("list:"))
+async def cb_list(callback: types.CallbackQuery):
+    offset = callback.data[len("list:"):]
+    if not offset.isdigit() or callback.message is None:
+        # not from one of our buttons, or the message is too old to edit
+        await callback.answer()
+        return
+    text, keyboard = listpage(callback.message.chat.id, int(offset))
+    if text is None:
+        text = "you don't have any active reminders right now."
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # the page didn't change
+        pass
+    await callback.answer()
+
+# ----------------------------------------------------------------------------
+# the find command, used to search the active reminders by their message
+# aliases: /f /find
+#
+# lists the reminders with a word starting with each of the terms, at most
+# one message's worth of them.
+@dp.message(Command(commands=["f", "find"]))
+async def cmd_find(message: types.Message, command: CommandObject):
+    if not command.args or not command.args.strip():
+        await message.answer("error: nothing to search for")
+        return
+    rems = reminders.find(message.chat.id, command.args)
+    if not rems:
+        await message.answer("no reminders found.")
+        return
+    lines = []
+    length = 0
+    for rem in rems:
+        line = f"reminder with ID {rem.job_id} -- will go off {rem.timestr}, type: {rem.type}, message: '{rem.message}'"
+        line = line[:remind.MAX_MESSAGE_LENGTH]
+        # leave room for the last line
+        if len(lines) == LIST_PAGE_SIZE or length + len(line) > remind.MAX_MESSAGE_LENGTH - 64:
+            lines.append(f"... and {len(rems) - len(lines)} more, use more terms to narrow it down.")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    await message.answer("\n".join(lines))
 
 # ----------------------------------------------------------------------------
-# the remove command, used to remove an active reminder
+# the remove command, used to remove active reminders
 # aliases: /r /rm /remove
+#
+# usage: /remove <IDs> | all | match <terms>
+# <IDs> is a list of reminder IDs and ranges of them, e.g '3 5 9-20'. only
+# the chat's own reminders are removed.
 @dp.message(Command(commands=["r", "rm", "remove"]))
 async def cmd_remove(message: types.Message, command: CommandObject):
-    if not command.args or not command.args.isdigit():
-        await message.answer("error: invalid reminder ID")
+    try:
+        job_ids = remind.selectreminders(reminders, message.chat.id, command.args or "")
+    except ValueError as e:
+        await message.answer(f"error: {e}")
+        return
+    if not job_ids:
+        await message.answer("error: no such reminders")
     else:
-        remove_job_by_id(int(command.args))
+        await message.answer(f"removed {remove_jobs(job_ids)} reminders.")
+
+# ----------------------------------------------------------------------------
+# check if the chat of <message> may set a new reminder that repeats every
+# <interval> seconds, or goes off once if it's None (see remind.Quotas).
+# with <create> False, no create is used up.
+#
+# returns False after answering with the reason if not.
+async def admit(message: types.Message, interval: float = None, create: bool = True) -> bool:
+    try:
+        quotas.check(message.chat.id, interval, create)
+    except ValueError as e:
+        await message.answer(f"error: {e}")
+        return False
+    return True
 
 # ----------------------------------------------------------------------------
 # the remindafter command
 # aliases: /ra /remindin /remindafter
 @dp.message(Command(commands=["ra", "remindin", "remindafter"]))
-async def cmd_remindafter(message: types.Message, command: CommandObject):
-    global reminder_type, waiting_for_prompt
+async def cmd_remindafter(message: types.Message, command: CommandObject, state: FSMContext):
     try:
-        global reminder_time
         reminder_time = remind.remindafter(command.args)
     except ValueError as e:
+        remind.metrics.inc("parse_errors_total")
         await message.answer(f"error: {e}")
         return
+    if not await admit(message, create=False):
+        return
     await message.answer("enter the reminder message: ")
-    reminder_type = "one-time"
-    waiting_for_prompt = True
+    await state.set_state(ReminderPrompt.message)
+    await state.set_data({"type": "one-time", "next_fire": reminder_time.timestamp()})
 
 # ----------------------------------------------------------------------------
 # the remindat command
 # aliases: /rt /remind /remindat
 @dp.message(Command(commands=["rt", "remind", "remindat"]))
-async def cmd_remindat(message: types.Message, command: CommandObject):
-    global reminder_type, waiting_for_prompt
+async def cmd_remindat(message: types.Message, command: CommandObject, state: FSMContext):
     try:
-        global reminder_time
         reminder_time = remind.remindat(command.args)
     except ValueError as e:
+        remind.metrics.inc("parse_errors_total")
         await message.answer(f"error: {e}")
         return
+    if not await admit(message, create=False):
+        return
     await message.answer("enter the reminder message: ")
-    reminder_type = "one-time"
-    waiting_for_prompt = True
+    await state.set_state(ReminderPrompt.message)
+    await state.set_data({"type": "one-time", "next_fire": reminder_time.timestamp()})
 
 # ----------------------------------------------------------------------------
 # the remindevery command
 # aliases: /re /remindevery
-
-# helper function used by cmd_remindevery -- convert an interval list to a
-# string description
-def intervalstr(interval: list) -> str:
-    s = ""
-    if interval[0] > 0:
-        s += f"{interval[0]} weeks, "
-    if interval[1] > 0:
-        s += f"{interval[1]} days, "
-    if interval[2] > 0:
-        s += f"{interval[2]} hours, "
-    if interval[3] > 0:
-        s += f"{interval[3]} minutes, "
-    if interval[4] > 0:
-        s += f"{interval[4]} seconds, "
-    return s[:-2]
-
 @dp.message(Command(commands=["re", "remindevery"]))
-async def cmd_remindevery(message: types.Message, command: CommandObject):
+async def cmd_remindevery(message: types.Message, command: CommandObject, state: FSMContext):
     try:
         iv = remind.remindevery(command.args)
     except ValueError as e:
+        remind.metrics.inc("parse_errors_total")
         await message.answer(f"error: {e}")
         return
     if not all(v == 0 for v in iv):
-        global reminder_interval, reminder_type, waiting_for_prompt
+        if not await admit(message, remind.intervalseconds(iv), create=False):
+            return
         await message.answer("enter the reminder message: ")
-        reminder_interval = iv
-        reminder_type = "repeating"
-        waiting_for_prompt = True
-
-# ----------------------------------------------------------------------------
-# if we're waiting for a prompt, this function will respond to a message
-# and set a reminder with the message that we got
-@dp.message(F.text)
-async def reminder_prompt(message: types.Message):
-    global waiting_for_prompt
-    if waiting_for_prompt:
-        if reminder_type == "one-time":
-            waiting_for_prompt = False
-            timestr = reminder_time.strftime("%c")
-            await message.answer(f"set reminder to {timestr}")
-            job_id = get_job_id()
-            reminders.append({"job": scheduler.add_job(do_remind, "date", args=[message, job_id], run_date=reminder_time),
-                              "job_id": job_id,
-                              "type": "one-time",
-                              "timestr": f"at {timestr}",
-                              "message": message.text})
-        elif reminder_type == "repeating":
-            iv = reminder_interval
-            ivstr = intervalstr(iv)
-            await message.answer(f"set reminder for every {ivstr}")
-            job_id = get_job_id()
-            reminders.append({"job": scheduler.add_job(do_remind, "interval", args=[message, -1], weeks=iv[0], days=iv[1], hours=iv[2], minutes=iv[3], seconds=iv[4]),
-                              "job_id": job_id,
-                              "type": "repeating",
-                              "timestr": f"every {ivstr}",
-                              "message": message.text})
+        await state.set_state(ReminderPrompt.message)
+        await state.set_data({"type": "repeating", "interval": iv})
 
 # ----------------------------------------------------------------------------
-# the main function
-async def main():
+# the stats command, used to show metrics. only available to admins.
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    if message.from_user is None or message.from_user.id not in ADMINS:
+        await message.answer("error: only admins can use /stats")
+        return
+    await message.answer(remind.metrics.summary() or "nothing recorded yet.")
+
+# ----------------------------------------------------------------------------
+# the import command, used to import reminders from a file
+# the file can be sent with /import as its caption, or after /import.
+@dp.message(Command("import"))
+async def cmd_import(message: types.Message, state: FSMContext):
+    if message.document:
+        await import_document(message)
+    else:
+        await message.answer("send the file to import (CSV, JSONL or iCalendar): ")
+        await state.set_state(ReminderPrompt.import_file)
+
+@dp.message(ReminderPrompt.import_file, F.document)
+async def import_prompt(message: types.Message, state: FSMContext):
+    await state.clear()
+    await import_document(message)
+
+# helper function used by the import command -- import the reminders of a
+# document. the file is parsed and the reminders are added a chunk at a time,
+# letting other handlers run in between.
+IMPORT_MAX_ERRORS = 20
+
+async def import_document(message: types.Message):
+    fmt = remind_io.fileformat(message.document.file_name or "")
+    if fmt is None:
+        await message.answer("error: unknown file format, use .csv, .jsonl or .ics")
+        return
+    # each imported reminder uses up a create, see quotas.trim
+    if not await admit(message, create=False):
+        return
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as f:
+        await bot.download(message.document, destination=f)
+        f.seek(0)
+        count, errors = 0, []
+        try:
+            lines = io.TextIOWrapper(f, encoding="utf-8", newline="")
+            for rems, errs in remind_io.importreminders(lines, fmt):
+                rems, over = quotas.trim(message.chat.id, rems)
+                reminders.add_many(rems, owner=message.chat.id)
+                for rem in rems:
+                    schedule_new(rem)
+                count += len(rems)
+                errs += [("?", error) for error in over]
+                errors += errs[:IMPORT_MAX_ERRORS - len(errors)]
+                await asyncio.sleep(0)
+        except UnicodeDecodeError:
+            errors.append(("?", "file is not valid UTF-8"))
+    answer = f"imported {count} reminders."
+    if errors:
+        answer += "\nerrors:\n" + "\n".join(f"row {row}: {error}" for row, error in errors)
+    await message.answer(answer[:remind.MAX_MESSAGE_LENGTH])
+
+# ----------------------------------------------------------------------------
+# the export command, used to export reminders to a file
+#
+# the file is generated while it's being uploaded.
+class ExportFile(types.InputFile):
+    def __init__(self, lines, filename: str):
+        super().__init__(filename=filename)
+        self.lines = lines
+
+    async def read(self, bot: Bot):
+        chunk, size = [], 0
+        for line in self.lines:
+            data = line.encode()
+            chunk.append(data)
+            size += len(data)
+            if size >= self.chunk_size:
+                yield b"".join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield b"".join(chunk)
+
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message, command: CommandObject):
+    fmt = (command.args or "csv").strip().lower()
+    if fmt not in remind_io.FORMATS:
+        await message.answer("error: format has to be one of csv, jsonl or ics")
+        return
+    if reminders.count(message.chat.id) == 0:
+        await message.answer("you don't have any active reminders right now.")
+        return
+    lines = remind_io.exportreminders(reminders.iter_owner(message.chat.id), fmt)
+    await message.answer_document(ExportFile(lines, f"reminders.{fmt}"))
+
+# ----------------------------------------------------------------------------
+# if this chat is waiting for a prompt, this function will respond to a
+# message and set a reminder with the message that we got
+BUSY_NOTE = "the bot is busy right now, so the reminder may go off late."
+
+@dp.message(ReminderPrompt.message, F.text)
+async def reminder_prompt(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.clear()
+    if data.get("type") == "one-time":
+        rem = remind.Reminder(message.text, data["next_fire"], reply_to=message.message_id)
+        answer = "set reminder to " + datetime.fromtimestamp(rem.next_fire).strftime("%c")
+    elif data.get("type") == "repeating":
+        iv = data["interval"]
+        seconds = remind.intervalseconds(iv)
+        rem = remind.Reminder(message.text, time.time() + seconds, seconds, reply_to=message.message_id)
+        answer = "set reminder for every " + remind.intervalstr(iv)
+    else:
+        return
+    # the commands only check the quotas before prompting, the create is used
+    # up here. nothing is awaited between the check and adding the reminder,
+    # so users of a group chat can't get past its limit together.
+    if not await admit(message, rem.interval):
+        return
+    reminders.add(rem, owner=message.chat.id)
+    busy = schedule_new(rem)
+    await message.answer(answer)
+    if busy:
+        await message.answer(BUSY_NOTE)
+
+# ----------------------------------------------------------------------------
+# starting up and shutting down
+async def startup():
+    if REMIND_DB:
+        restore()
+        scheduler.add_job(schedule_restored, "interval", seconds=RESTORE_HORIZON / 2)
+        scheduler.add_job(reminders.flush, "interval", seconds=reminders.flush_interval)
+    if firecap.limit > 0:
+        scheduler.add_job(fire_deferred, "interval", seconds=firecap.tick)
+    if quotas.mode == "defer" and quotas.max_backlog > 0:
+        scheduler.add_job(admit_deferred, "interval", seconds=1)
     scheduler.start()
+    delivery.start()
+    if os.getenv("REMIND_METRICS_PORT"):
+        remind.serve_metrics(int(os.getenv("REMIND_METRICS_PORT")))
     logging.basicConfig(level=logging.INFO)
-    await dp.start_polling(bot)
+
+async def shutdown():
+    scheduler.shutdown(wait=False)
+    await delivery.drain(timeout=10)
+    await bot.session.close()
+    reminders.flush()
+
+# ----------------------------------------------------------------------------
+# run as a worker of a sharded deployment (see aiogram_shards.py): handle the
+# updates the front process puts in <updates>, a multiprocessing queue of raw
+# update dicts, until it puts None.
+async def run_worker(updates):
+    await startup()
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        while (update := await loop.run_in_executor(None, updates.get)) is not None:
+            task = asyncio.create_task(dp.feed_raw_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        await shutdown()
+
+# ----------------------------------------------------------------------------
+# the main function
+async def main():
+    await startup()
+    try:
+        await aiogram_webhook.run(dp, bot)
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,179 @@
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+import asyncio
+import glob
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import sqlite3
+
+# package modules
+from aiogram import Dispatcher
+
+from dotenv import load_dotenv
+
+# custom modules
+import aiogram_webhook
+import remind
+
+# ----------------------------------------------------------------------------
+# sharded deployment of the aiogram frontend: python aiogram_shards.py
+#
+# a front process receives the updates (by long polling or a webhook, as set
+# by REMIND_MODE, see aiogram_webhook.py) and passes each one on to one of
+# REMIND_WORKERS worker processes (default: one per CPU), picked by the ID of
+# the chat it came from. every worker runs the handlers of aiogram_frontend.py
+# with its own scheduler, delivery queue and reminders, so all of a chat's
+# reminders and prompts live in one worker.
+#
+# the workers share the settings of the front process, except that:
+# - worker <n> keeps its reminders in <REMIND_DB>.<n>, and an SQLite FSM
+#   storage in <path>.<n>.
+# - REMIND_SEND_RATE is split evenly between the workers, since Telegram's
+#   flood limit is per bot.
+# - worker <n> serves its metrics on REMIND_METRICS_PORT + <n>.
+#
+# if the number of workers changes, reminders are moved to the database of
+# their new shard on startup, before the workers start. reminders in a
+# database of an unsharded deployment (<REMIND_DB> itself) are moved too.
+# moved reminders get new IDs.
+
+# get the shard of a chat
+def shardof(chat_id: int, shards: int) -> int:
+    return chat_id % shards
+
+def shardpath(path: str, shard: int) -> str:
+    return f"{path}.{shard}"
+
+# move the reminders in the databases at <path> and <path>.<n> to the
+# databases of their shards, out of <shards>. shard databases past the last
+# shard are deleted once they're empty.
+#
+# returns the number of reminders that were moved.
+def rebalance(path: str, shards: int) -> int:
+    targets = [shardpath(path, shard) for shard in range(shards)]
+    for target in targets:
+        # creates the database if it doesn't exist yet
+        remind.SQLiteReminderStore(target).close()
+
+    sources = {}
+    if os.path.exists(path):
+        sources[path] = None
+    for source in glob.glob(glob.escape(path) + ".*"):
+        match = re.fullmatch(r"\.(\d+)", source[len(path):])
+        if match:
+            sources[source] = int(match[1])
+
+    moved = 0
+    for source, shard in sources.items():
+        # brings databases from older versions up to the current schema
+        remind.SQLiteReminderStore(source).close()
+        db = sqlite3.connect(source)
+        try:
+            if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'reminders'").fetchone():
+                continue
+            for target, targetpath in enumerate(targets):
+                if target == shard:
+                    continue
+                db.execute("ATTACH DATABASE ? AS target", (targetpath,))
+                with db:
+                    # SQLite's % keeps the sign of the dividend, Python's
+                    # (used by shardof) doesn't
+                    cond = "((owner % :n) + :n) % :n = :shard"
+                    args = {"n": shards, "shard": target}
+                    moved += db.execute(f"""INSERT INTO target.reminders (owner, reply_to, message, next_fire, interval, jitter)
+                                            SELECT owner, reply_to, message, next_fire, interval, jitter
+                                            FROM main.reminders WHERE {cond}""", args).rowcount
+                    db.execute(f"DELETE FROM main.reminders WHERE {cond}", args)
+                db.execute("DETACH DATABASE target")
+            empty = db.execute("SELECT COUNT(*) FROM reminders").fetchone()[0] == 0
+        finally:
+            db.close()
+        if shard is not None and shard >= shards and empty:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(source + suffix):
+                    os.remove(source + suffix)
+    return moved
+
+# ----------------------------------------------------------------------------
+# the worker processes
+
+# the environment of worker <shard>
+def workerenv(shard: int, shards: int) -> dict:
+    env = {}
+    if os.getenv("REMIND_DB"):
+        env["REMIND_DB"] = shardpath(os.getenv("REMIND_DB"), shard)
+    fsm = os.getenv("REMIND_FSM_STORAGE", "memory")
+    if fsm.startswith("sqlite:"):
+        env["REMIND_FSM_STORAGE"] = shardpath(fsm, shard)
+    env["REMIND_SEND_RATE"] = str(float(os.getenv("REMIND_SEND_RATE", "30")) / shards)
+    if os.getenv("REMIND_METRICS_PORT"):
+        env["REMIND_METRICS_PORT"] = str(int(os.getenv("REMIND_METRICS_PORT")) + shard)
+    return env
+
+def worker(env: dict, updates):
+    # a ^C in the terminal goes to every process in the group, but only the
+    # front process should act on it: the workers stop once it tells them to,
+    # after the updates it already received
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update(env)
+    import aiogram_frontend
+    asyncio.run(aiogram_frontend.run_worker(updates))
+
+# ----------------------------------------------------------------------------
+# the front process
+
+# a dispatcher that passes every update on to the worker of its chat, as a
+# raw update dict. updates without a chat are spread by their ID.
+def frontdispatcher(queues: list) -> Dispatcher:
+    dp = Dispatcher()
+
+    @dp.update.outer_middleware()
+    async def route(handler, event, data):
+        chat = data.get("event_chat")
+        key = chat.id if chat is not None else event.update_id
+        queues[shardof(key, len(queues))].put(event.model_dump(mode="json", exclude_unset=True))
+
+    return dp
+
+async def front(queues: list):
+    bot = aiogram_webhook.make_bot()
+    try:
+        await aiogram_webhook.run(frontdispatcher(queues), bot)
+    finally:
+        await bot.session.close()
+
+# ----------------------------------------------------------------------------
+# the main function
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    shards = int(os.getenv("REMIND_WORKERS", "0")) or os.cpu_count()
+    if os.getenv("REMIND_DB"):
+        moved = rebalance(os.getenv("REMIND_DB"), shards)
+        if moved:
+            logging.info("moved %d reminders to their new shards", moved)
+
+    # spawn, so the workers don't inherit the front's event loop or bot
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(shards)]
+    workers = [ctx.Process(target=worker, args=(workerenv(shard, shards), queues[shard]), name=f"remind-worker-{shard}")
+               for shard in range(shards)]
+    for proc in workers:
+        proc.start()
+    try:
+        asyncio.run(front(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for proc in workers:
+            proc.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+from collections import OrderedDict
+
+import json
+import sqlite3
+import time
+
+# package modules
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+
+# ----------------------------------------------------------------------------
+# FSM storages for the aiogram frontend.
+#
+# both storages forget the state and data of a key <ttl> seconds after they
+# were last set, so prompts that were never answered don't pile up. state data
+# has to be JSON serializable, so the storages can be swapped for each other
+# (or for aiogram's RedisStorage) without changing the handlers.
+
+# get the name of a state, which may be a State object, a string or None.
+def statename(state) -> str:
+    if isinstance(state, State):
+        return state.state
+    return state
+
+# ----------------------------------------------------------------------------
+# in-memory FSM storage with a TTL.
+#
+# keys are kept in an OrderedDict in the order they were last set, so the
+# expired ones are always at the front and are dropped whenever a key is set,
+# without scanning the other keys.
+class TTLMemoryStorage(BaseStorage):
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._records = OrderedDict()
+
+    def _sweep(self, now: float):
+        records = self._records
+        while records:
+            key, (_, _, expires) = next(iter(records.items()))
+            if expires > now:
+                break
+            del records[key]
+
+    def _get(self, key: StorageKey) -> tuple:
+        record = self._records.get(key)
+        if record is None or record[2] <= time.time():
+            return None, {}
+        return record
+
+    def _set(self, key: StorageKey, state, data: dict):
+        now = time.time()
+        self._sweep(now)
+        self._records.pop(key, None)
+        if state is not None or data:
+            self._records[key] = (state, data, now + self.ttl)
+
+    async def set_state(self, key: StorageKey, state=None):
+        self._set(key, statename(state), self._get(key)[1])
+
+    async def get_state(self, key: StorageKey):
+        return self._get(key)[0]
+
+    async def set_data(self, key: StorageKey, data):
+        self._set(key, self._get(key)[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict(self._get(key)[1])
+
+    # get the amount of keys that are stored, including expired ones that
+    # weren't dropped yet.
+    def __len__(self) -> int:
+        return len(self._records)
+
+    async def close(self):
+        self._records.clear()
+
+# ----------------------------------------------------------------------------
+# FSM storage backed by a local SQLite database, so pending prompts survive a
+# restart. expired rows are deleted at most every <ttl> / 10 seconds, when a
+# key is set.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        self._keys = DefaultKeyBuilder(with_destiny=True, with_bot_id=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS fsm (
+                                key TEXT PRIMARY KEY,
+                                state TEXT,
+                                data TEXT NOT NULL,
+                                expires REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS fsm_expires ON fsm (expires)")
+        self._db.commit()
+        self._last_sweep = 0.0
+
+    def _get(self, key: StorageKey) -> tuple:
+        row = self._db.execute("SELECT state, data FROM fsm WHERE key = ? AND expires > ?",
+                               (self._keys.build(key), time.time())).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def _set(self, key: StorageKey, state, data: dict):
+        now = time.time()
+        with self._db:
+            if now - self._last_sweep >= self.ttl / 10:
+                self._last_sweep = now
+                self._db.execute("DELETE FROM fsm WHERE expires <= ?", (now,))
+            if state is None and not data:
+                self._db.execute("DELETE FROM fsm WHERE key = ?", (self._keys.build(key),))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?)",
+                                 (self._keys.build(key), state, json.dumps(data), now + self.ttl))
+
+    async def set_state(self, key: StorageKey, state=None):
+        self._set(key, statename(state), self._get(key)[1])
+
+    async def get_state(self, key: StorageKey):
+        return self._get(key)[0]
+
+    async def set_data(self, key: StorageKey, data):
+        self._set(key, self._get(key)[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return self._get(key)[1]
+
+    async def close(self):
+        self._db.close()
+
+# ----------------------------------------------------------------------------
+# create an FSM storage from a spec string:
+# "memory" for TTLMemoryStorage, "sqlite:<path>" for SQLiteStorage, or a
+# redis:// URL for aiogram's RedisStorage (this works with any server that
+# speaks the Redis protocol, and requires the redis package).
+def make_storage(spec: str, ttl: float) -> BaseStorage:
+    if spec == "memory":
+        return TTLMemoryStorage(ttl)
+    elif spec.startswith("sqlite:"):
+        return SQLiteStorage(spec[len("sqlite:"):], ttl)
+    elif spec.startswith(("redis://", "rediss://", "unix://")):
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(spec, state_ttl=int(ttl), data_ttl=int(ttl))
+    else:
+        raise ValueError(f"unknown FSM storage '{spec}'")
@@ -0,0 +1,89 @@
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+import asyncio
+import os
+import signal
+
+# package modules
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from aiohttp import web
+
+# ----------------------------------------------------------------------------
+# the bot, with the token in BOT_TOKEN. if REMIND_BOT_API is set, the bot
+# talks to the Bot API server at that URL (e.g a local Bot API server, or
+# fake_telegram.py) instead of Telegram's.
+def make_bot() -> Bot:
+    if os.getenv("REMIND_BOT_API"):
+        session = AiohttpSession(api=TelegramAPIServer.from_base(os.getenv("REMIND_BOT_API")))
+        return Bot(token=os.getenv("BOT_TOKEN"), session=session)
+    return Bot(token=os.getenv("BOT_TOKEN"))
+
+# ----------------------------------------------------------------------------
+# receiving updates for the aiogram frontend, by long polling or a webhook.
+#
+# if REMIND_MODE is "webhook", updates are received by an aiohttp server on
+# REMIND_WEBHOOK_HOST:REMIND_WEBHOOK_PORT at REMIND_WEBHOOK_PATH instead of
+# by long polling. if REMIND_WEBHOOK_URL is set, the webhook is registered
+# with Telegram as that URL on startup. requests without the secret token in
+# REMIND_WEBHOOK_SECRET (if it's set) are rejected.
+#
+# updates are handled concurrently, at most REMIND_WEBHOOK_MAX_INFLIGHT at a
+# time; further requests wait for a free slot, which makes Telegram slow down.
+#
+# in both modes, the bot session is left open, so the caller can still send
+# messages (e.g drain its delivery queue) after the updates stop.
+WEBHOOK_HOST = os.getenv("REMIND_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("REMIND_WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("REMIND_WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("REMIND_WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("REMIND_WEBHOOK_SECRET")
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("REMIND_WEBHOOK_MAX_INFLIGHT", "40"))
+
+class WebhookHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, limit: int, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=False, **kwargs)
+        self.inflight = asyncio.Semaphore(limit)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        async with self.inflight:
+            return await super().handle(request)
+
+    async def close(self):
+        # the bot session is closed by the caller
+        pass
+
+# serve the webhook until we get SIGINT or SIGTERM. on shutdown, the server
+# stops accepting requests and waits for the ones in flight.
+async def run_webhook(dispatcher: Dispatcher, bot: Bot):
+    app = web.Application()
+    handler = WebhookHandler(dispatcher, bot, WEBHOOK_MAX_INFLIGHT, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_INFLIGHT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+# receive updates in the mode set by REMIND_MODE until we're stopped.
+async def run(dispatcher: Dispatcher, bot: Bot):
+    if os.getenv("REMIND_MODE", "polling") == "webhook":
+        await run_webhook(dispatcher, bot)
+    else:
+        await dispatcher.start_polling(bot, close_bot_session=False)
@@ -0,0 +1,314 @@
+# ----------------------------------------------------------------------------
+# benchmarks for the hot paths of remind and its frontends.
+#
+# usage: python bench.py [--sizes 1000,10000,100000] [--only parse,store,...]
+#                        [--output results.json] [--baseline old.json]
+#                        [--tolerance 0.2]
+#
+# every benchmark reports one number. results are printed, and written as JSON
+# with --output. with --baseline, results are compared against an earlier
+# JSON file and the exit status is 1 if any of them got worse by more than
+# --tolerance (a fraction, 0.2 = 20%).
+#
+# the "handlers" benchmark needs aiogram and runs the bot's handlers against
+# a fake Bot API session that answers every request locally; it is skipped if
+# aiogram isn't installed.
+
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+from datetime import datetime
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+# custom modules
+import remind
+
+# ----------------------------------------------------------------------------
+# results
+
+results = {}
+
+# record a result. <better> is "higher" or "lower".
+def record(name: str, value: float, unit: str, better: str):
+    results[name] = {"value": value, "unit": unit, "better": better}
+    print(f"{name:<48} {value:>16.6g} {unit}")
+
+# run <func> <n> times and record how many calls per second it manages.
+def throughput(name: str, func, n: int):
+    start = time.perf_counter()
+    func(n)
+    elapsed = time.perf_counter() - start
+    record(name, n / elapsed, "ops/s", "higher")
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+# ----------------------------------------------------------------------------
+# parsing
+
+DURATIONS = ["10s", "10m", "1h", "1h 30m", "2 days", "5m 10 seconds", "1w"]
+DATETIMES = ["23:59:59", "2099/01/01", "2099/12/31 12:00:00", "12:00:00 2099/06/15"]
+
+def bench_parse(sizes: list):
+    n = 100000
+    queries = list(itertools.islice(itertools.cycle(DURATIONS), n))
+    times = list(itertools.islice(itertools.cycle(DATETIMES), n))
+
+    def after(n):
+        for q in queries:
+            remind.remindafter(q)
+    def every(n):
+        for q in queries:
+            remind.remindevery(q)
+    def at(n):
+        for q in times:
+            remind.remindat(q)
+    def after_uncached(n):
+        for i in range(n):
+            remind.remindafter(f"{i}s")
+
+    throughput("parse.remindafter", after, n)
+    throughput("parse.remindafter.uncached", after_uncached, n)
+    throughput("parse.remindevery", every, n)
+    throughput("parse.remindat", at, n)
+    for size in sizes:
+        batch = list(itertools.islice(itertools.cycle(DURATIONS), size))
+        throughput(f"parse.parse_many.after.{size}", lambda n: remind.parse_many(batch, "after"), size)
+
+# ----------------------------------------------------------------------------
+# the reminder store: what get_job_id and remove_job_by_id used to do
+
+def bench_store(sizes: list):
+    for size in sizes:
+        store = remind.ReminderStore()
+        rems = [remind.Reminder("bench", 0.0) for _ in range(size)]
+
+        def add(n):
+            for i, rem in enumerate(rems):
+                store.add(rem, owner=i % 1000)
+        def remove(n):
+            for i in range(0, size, 2):
+                store.remove(i)
+        def readd(n):
+            for i in range(0, size, 2):
+                store.add(rems[i], owner=i % 1000)
+
+        throughput(f"store.add.{size}", add, size)
+        throughput(f"store.remove.{size}", remove, size // 2)
+        throughput(f"store.add_reused_id.{size}", readd, size // 2)
+
+# ----------------------------------------------------------------------------
+# end-to-end scheduling: schedule reminders with the native scheduler and
+# measure how late they fire
+
+def bench_fire(sizes: list):
+    for size in sizes:
+        lags = []
+
+        def fire(when):
+            lags.append(time.time() - when)
+
+        async def run():
+            scheduler = remind.AsyncioReminderScheduler()
+            scheduler.start()
+            start = time.perf_counter()
+            base = time.time() + 0.5
+            for i in range(size):
+                when = base + (i % 1000) / 1000
+                scheduler.add_job(fire, "date", args=[when], run_date=when)
+            record(f"fire.schedule.{size}", size / (time.perf_counter() - start), "ops/s", "higher")
+            while len(lags) < size:
+                await asyncio.sleep(0.05)
+            scheduler.shutdown()
+
+        asyncio.run(run())
+        record(f"fire.lag_p50.{size}", percentile(lags, 0.5), "s", "lower")
+        record(f"fire.lag_p99.{size}", percentile(lags, 0.99), "s", "lower")
+
+# ----------------------------------------------------------------------------
+# repeating reminders with a few common intervals, with one timer each and
+# with shared timers
+
+def bench_groups(sizes: list):
+    intervals = [1800, 3600, 86400]
+    for size in sizes:
+        now = time.time()
+        rems = []
+        for i in range(size):
+            rem = remind.Reminder(f"message {i}", now + (i * 7) % 3600, intervals[i % 3])
+            rem.job_id = i
+            rems.append(rem)
+
+        scheduler = remind.ReminderScheduler()
+        start = time.perf_counter()
+        for rem in rems:
+            scheduler.add_job(print, "interval", args=[rem], seconds=rem.interval, next_run_time=rem.next_fire)
+        record(f"groups.add_unshared.{size}", size / (time.perf_counter() - start), "ops/s", "higher")
+        record(f"groups.timers_unshared.{size}", len(scheduler), "timers", "lower")
+
+        scheduler = remind.ReminderScheduler()
+        timers = remind.SharedTimers(scheduler, print)
+        start = time.perf_counter()
+        shared = [timers.add(rem) for rem in rems]
+        record(f"groups.add_shared.{size}", size / (time.perf_counter() - start), "ops/s", "higher")
+        record(f"groups.timers_shared.{size}", len(scheduler), "timers", "lower")
+        start = time.perf_counter()
+        for timer in shared:
+            timer.remove()
+        record(f"groups.remove_shared.{size}", size / (time.perf_counter() - start), "ops/s", "higher")
+
+# ----------------------------------------------------------------------------
+# listing, as /list in the CLI frontend renders it
+
+def bench_list(sizes: list):
+    for size in sizes:
+        store = remind.ReminderStore()
+        now = time.time()
+        for i in range(size):
+            store.add(remind.Reminder(f"message {i}", now + i, 60 if i % 2 else None), owner=i % 10)
+
+        def render(n):
+            for owner in range(10):
+                for rem in store.iter_owner(owner):
+                    f"reminder with ID {rem.job_id} -- will go off {rem.timestr}, type: {rem.type}, message: '{rem.message}'"
+        def firstpage(n):
+            for _ in range(n):
+                for rem in store.iter_owner(0, 0, limit=21):
+                    rem.timestr
+
+        throughput(f"list.render_all.{size}", render, size)
+        throughput(f"list.first_page.{size}", firstpage, 1000)
+
+# ----------------------------------------------------------------------------
+# aiogram handlers against a fake Bot API session
+
+def bench_handlers(sizes: list):
+    try:
+        os.environ.setdefault("BOT_TOKEN", "123456:bench")
+        os.environ.setdefault("REMIND_SCHEDULER", "native")
+        from aiogram.client.session.base import BaseSession
+        from aiogram.types import Chat, Message, Update, User
+        import aiogram_frontend
+    except ImportError as e:
+        print(f"skipping handlers benchmark: {e}")
+        return
+
+    # answers every request without any network traffic
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            if hasattr(method, "text") and hasattr(method, "chat_id"):
+                return Message(message_id=1, date=datetime.now(), chat=Chat(id=method.chat_id, type="private"),
+                               text=method.text)
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    bot, dp = aiogram_frontend.bot, aiogram_frontend.dp
+    bot.session = FakeSession()
+    ids = itertools.count(1)
+
+    def update(chat_id: int, text: str) -> Update:
+        return Update(update_id=next(ids),
+                      message=Message(message_id=next(ids), date=datetime.now(), text=text,
+                                      chat=Chat(id=chat_id, type="private"),
+                                      from_user=User(id=chat_id, is_bot=False, first_name="bench")))
+
+    async def run(size: int):
+        aiogram_frontend.scheduler.start()
+        chats = 100
+        start = time.perf_counter()
+        latencies = []
+        for i in range(size // 2):
+            chat_id = i % chats
+            for text in ("/remindafter 1h", f"reminder {i}"):
+                t = time.perf_counter()
+                await dp.feed_update(bot, update(chat_id, text))
+                latencies.append(time.perf_counter() - t)
+        record(f"handlers.create.{size}", size / (time.perf_counter() - start), "updates/s", "higher")
+        record(f"handlers.latency_p99.{size}", percentile(latencies, 0.99), "s", "lower")
+
+        start = time.perf_counter()
+        for i in range(1000):
+            await dp.feed_update(bot, update(i % chats, "/list"))
+        record(f"handlers.list.{size}", 1000 / (time.perf_counter() - start), "updates/s", "higher")
+        aiogram_frontend.scheduler.shutdown()
+
+    for size in sizes:
+        aiogram_frontend.reminders = remind.ReminderStore()
+        asyncio.run(run(size))
+
+# ----------------------------------------------------------------------------
+# the main function
+
+BENCHMARKS = {
+        "parse": bench_parse,
+        "store": bench_store,
+        "fire": bench_fire,
+        "groups": bench_groups,
+        "list": bench_list,
+        "handlers": bench_handlers
+}
+
+# compare the results against a baseline.
+#
+# returns the names of the benchmarks that regressed.
+def compare(baseline: dict, tolerance: float) -> list:
+    regressed = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None or old["value"] == 0:
+            continue
+        change = (result["value"] - old["value"]) / old["value"]
+        if result["better"] == "lower":
+            change = -change
+        status = "REGRESSED" if change < -tolerance else "ok"
+        print(f"{name:<48} {change:>+8.1%} {status}")
+        if change < -tolerance:
+            regressed.append(name)
+    return regressed
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="benchmark remind's hot paths")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma-separated reminder counts (default: %(default)s)")
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+                        help="comma-separated benchmarks to run (default: %(default)s)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression against the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    for name in args.only.split(","):
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}'")
+        BENCHMARKS[name](sizes)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "time": datetime.now().isoformat(), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,144 +4,837 @@
 # builtin modules
 from datetime import datetime, timedelta
 
+import asyncio
+import codecs
+import contextlib
+import functools
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
 # package modules
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # custom modules
 import remind
+import remind_client
+import remind_io
 
 # ----------------------------------------------------------------------------
 # global variables
-scheduler = BackgroundScheduler()
-reminders = []
-job_ids = []
+# with --async, commands are read and reminders go off on one asyncio event
+# loop in the main thread, instead of in a scheduler thread next to a
+# blocking input() (see main_async).
+ASYNC_MODE = "--async" in sys.argv[1:]
+
+# if REMIND_SCHEDULER is "native", reminders are scheduled with remind's own
+# scheduler instead of APScheduler. REMIND_SLACK sets how many seconds late
+# it may fire reminders to group them into fewer wakeups.
+if os.getenv("REMIND_SCHEDULER") == "native":
+    slack = float(os.getenv("REMIND_SLACK", "0"))
+    scheduler = remind.AsyncioReminderScheduler(slack) if ASYNC_MODE else remind.ThreadReminderScheduler(slack)
+else:
+    scheduler = AsyncIOScheduler() if ASYNC_MODE else BackgroundScheduler()
+
+# if REMIND_DB is set, reminders are kept in an SQLite database at that path
+# and restored on startup.
+#
+# if REMIND_SPREAD is set, every new reminder goes off up to that many
+# seconds late (always the same amount for the same reminder, see
+# remind.jitterfor), so reminders set for the same time don't all go off
+# in the same second.
+REMIND_DB = os.getenv("REMIND_DB")
+SPREAD = float(os.getenv("REMIND_SPREAD", "0"))
+if REMIND_DB:
+    reminders = remind.SQLiteReminderStore(REMIND_DB, spread=SPREAD)
+else:
+    reminders = remind.ReminderStore(SPREAD)
+
+# restored reminders are only scheduled once they are due within this many
+# seconds, so restoring lots of them doesn't create a job for each at once.
+RESTORE_HORIZON = 60
+restored_until = float("-inf")
+
+# reminders that should have gone off while we weren't running are handled
+# according to REMIND_MISFIRE ("once", "all", "skip" or "coalesce", see
+# remind.CatchUp), or REMIND_MISFIRE_REPEATING for repeating reminders, at
+# most REMIND_CATCHUP_RATE per second.
+CATCHUP_RATE = int(os.getenv("REMIND_CATCHUP_RATE", "10"))
+catchup_job = None
+
+# metrics, shown by /stats. if REMIND_METRICS_PORT is set, they are also
+# served in the Prometheus text format at http://127.0.0.1:<port>/metrics.
+remind.metrics.gauge("pending_reminders", reminders.counts)
+if isinstance(scheduler, remind.ReminderScheduler):
+    remind.metrics.gauge("scheduler_timers", scheduler.__len__)
+
+# held while printing a line and sending it to the watchers, so lines from
+# different threads aren't mixed up
+output_lock = threading.Lock()
+
+# print a line, and send it to the clients running 'watch' in daemon mode
+def show(text: str):
+    with output_lock:
+        print(text)
+        notify_watchers(text + "\n")
+
+catchup = remind.CatchUp(reminders,
+                         lambda rem: show(f"REMINDER - {rem.message}"),
+                         lambda owner, text: show(text),
+                         os.getenv("REMIND_MISFIRE", "once"), os.getenv("REMIND_MISFIRE_REPEATING"))
+remind.metrics.gauge("missed_fires_pending", catchup.__len__)
+
+# limits on new reminders, see remind.Quotas: at most REMIND_MAX_REMINDERS
+# reminders, that repeat at most every REMIND_MIN_INTERVAL seconds, and
+# REMIND_CREATE_RATE set per minute, in bursts of REMIND_CREATE_BURST. 0 means
+# no limit. while more than REMIND_MAX_BACKLOG reminders are waiting to go
+# off, new reminders are refused, or with REMIND_BACKPRESSURE=defer, accepted
+# but only scheduled once the backlog is down again.
+quotas = remind.Quotas(reminders,
+                       max_reminders=int(os.getenv("REMIND_MAX_REMINDERS", "0")),
+                       min_interval=float(os.getenv("REMIND_MIN_INTERVAL", "0")),
+                       create_rate=float(os.getenv("REMIND_CREATE_RATE", "0")) / 60,
+                       create_burst=float(os.getenv("REMIND_CREATE_BURST", "0")),
+                       backlog=lambda: len(firecap) + len(catchup),
+                       max_backlog=int(os.getenv("REMIND_MAX_BACKLOG", "0")),
+                       mode=os.getenv("REMIND_BACKPRESSURE", "reject"))
+remind.metrics.gauge("deferred_reminders", quotas.__len__)
 
 # ----------------------------------------------------------------------------
 # job management
 
-# get a job id.
-def get_job_id() -> int:
-    job_id = 0
-    while job_id in job_ids:
-        job_id += 1
-    job_ids.append(job_id)
-    return job_id
+# decorator for the functions run by the scheduler. in async mode, they are
+# wrapped in coroutine functions, since AsyncIOScheduler would run plain
+# functions in a thread pool.
+def job(func):
+    if not ASYNC_MODE:
+        return func
+
+    @functools.wraps(func)
+    async def run(*args):
+        return func(*args)
+    return run
+
+# held while creating or cancelling a job. schedule_restored runs in another
+# thread and may see a reminder that was just added before its job was
+# created, so scheduling has to be atomic.
+schedule_lock = threading.Lock()
+
+# create the scheduler job of a reminder, unless it already has one or was
+# removed in the meantime.
+def schedule(rem: remind.Reminder):
+    with schedule_lock:
+        if rem.job is not None or reminders.get(rem.job_id) is not rem:
+            return
+        now = time.time()
+        if rem.interval is not None and shared_timers is not None:
+            rem.job = shared_timers.add(rem)
+        elif rem.interval is not None:
+            next_fire = remind.nextfire(rem.fire_at, rem.interval, now)
+            rem.job = scheduler.add_job(do_remind, "interval", args=[rem], seconds=rem.interval,
+                                        next_run_time=datetime.fromtimestamp(next_fire))
+        else:
+            # reminders that were due while we weren't running fire right away
+            run_date = datetime.fromtimestamp(max(rem.fire_at, now))
+            rem.job = scheduler.add_job(do_remind, "date", args=[rem], run_date=run_date)
+
+# schedule a reminder that was just set, unless it has to wait until we
+# aren't busy anymore.
+#
+# returns True if it has to wait.
+def schedule_new(rem: remind.Reminder) -> bool:
+    if quotas.defer(rem):
+        return True
+    schedule(rem)
+    return False
+
+# schedule the reminders that waited for us to not be busy, runs every second
+# with REMIND_BACKPRESSURE=defer.
+@job
+def admit_deferred():
+    quotas.step(schedule)
+
+# restore the reminders from the database. the ones that should have gone
+# off while we weren't running are handed to catchup.
+def restore():
+    global restored_until, catchup_job
+    reminders.load()
+    now = time.time()
+    missed = reminders.due_between(float("-inf"), now)
+    catchup.add(missed, reminders.last_seen, now)
+    for rem in missed:
+        if rem.interval is not None:
+            schedule(rem)
+    restored_until = now
+    schedule_restored()
+    if len(catchup) > 0:
+        catchup_job = scheduler.add_job(catch_up, "interval", seconds=1)
+
+# handle the next missed fires, runs every second until they're all done.
+@job
+def catch_up():
+    if catchup.step(CATCHUP_RATE) == 0:
+        catchup_job.remove()
+
+# schedule the restored reminders that are due soon. runs every
+# RESTORE_HORIZON / 2 seconds, each run only looks at the reminders that
+# became due since the last one. restore() also calls it directly, so it is
+# only wrapped with job() when it is added to the scheduler.
+def schedule_restored():
+    global restored_until
+    end = time.time() + RESTORE_HORIZON
+    for rem in reminders.due_between(restored_until, end):
+        schedule(rem)
+    restored_until = end
+
+# cancel the scheduler job of a reminder, if it has one.
+def cancel(rem: remind.Reminder):
+    with schedule_lock:
+        job, rem.job = rem.job, None
+    if job is not None:
+        try:
+            job.remove()
+        except JobLookupError:
+            # it already went off
+            pass
 
 # remove a job by its job id.
 def remove_job_by_id(job_id: int):
-    for rem in reminders[:]:
-        if rem["job_id"] == job_id:
-            if rem["type"] == "repeating":
-                rem["job"].remove()
-            job_ids.remove(rem["job_id"])
-            reminders.remove(rem)
+    rem = reminders.remove(job_id)
+    if rem is not None:
+        cancel(rem)
+
+# remove many jobs by their job ids at once.
+#
+# returns the amount of removed jobs.
+def remove_jobs(job_ids: list) -> int:
+    removed = reminders.remove_many(job_ids)
+    for rem in removed:
+        cancel(rem)
+    return len(removed)
 
 # ----------------------------------------------------------------------------
-# print a reminder message - used by scheduled jobs
-def do_remind(reminder_msg: str, job_id: int):
-    print(f"REMINDER - {reminder_msg}")
-    if job_id >= 0:
-        remove_job_by_id(job_id)
+# print a reminder message, unless it was removed since it went off
+def fire(rem: remind.Reminder):
+    if reminders.get(rem.job_id) is not rem:
+        return
+    now = time.time()
+    remind.metrics.observe("fire_lag_seconds", now - rem.due(now))
+    remind.metrics.inc("reminders_fired_total")
+    show(f"REMINDER - {rem.message}")
+    if rem.interval is None:
+        # the job is done, there's nothing to cancel
+        rem.job = None
+        remove_job_by_id(rem.job_id)
+
+# at most REMIND_MAX_FIRES reminders are fired per second, the rest are fired
+# in the next seconds (see remind.FireCap). 0 means no limit.
+firecap = remind.FireCap(fire, int(os.getenv("REMIND_MAX_FIRES", "0")))
+remind.metrics.gauge("fires_deferred", firecap.__len__)
+
+# the scheduled jobs
+@job
+def do_remind(rem: remind.Reminder):
+    firecap(rem)
+
+# the job of a group of repeating reminders that share one
+@job
+def do_remind_group(group: remind.TimerGroup):
+    for rem in group:
+        firecap(rem)
+
+@job
+def fire_deferred():
+    firecap.step()
+
+# repeating reminders with the same interval whose fires line up share one
+# scheduler job, see remind.SharedTimers. fires are lined up by rounding them
+# up to REMIND_TIMER_GRANULARITY seconds, so they go off up to that late. with
+# 0, every reminder gets its own job.
+TIMER_GRANULARITY = float(os.getenv("REMIND_TIMER_GRANULARITY", "1"))
+if TIMER_GRANULARITY > 0:
+    shared_timers = remind.SharedTimers(scheduler, do_remind_group, TIMER_GRANULARITY)
+    remind.metrics.gauge("timer_groups", shared_timers.__len__)
+else:
+    shared_timers = None
 
 # ----------------------------------------------------------------------------
 # the list command, used to list all active reminders
 # aliases: /l /ls /list
-def cmd_list():
-    if len(reminders) == 0:
-        print("you don't have any active reminders right now.")
-    else:
-        for rem in reminders:
-            print(f"reminder with ID {rem['job_id']} -- will go off {rem['timestr']}, type: {rem['type']}, message: '{rem['message']}'")
+#
+# usage: /list [offset] [count]
+# lists <count> reminders (or all of them) starting at the <offset>th one.
+# reminders are printed as they are read, instead of all at once at the end.
+def cmd_list(query: str):
+    args = query.split()
+    if len(args) > 2 or not all(arg.isdigit() for arg in args):
+        print("error: invalid offset or count")
+        return
+    offset = int(args[0]) if len(args) > 0 else 0
+    count = int(args[1]) if len(args) > 1 else None
+
+    shown = 0
+    for rem in reminders.iter_owner(None, offset, limit=count):
+        print(f"reminder with ID {rem.job_id} -- will go off {rem.timestr}, type: {rem.type}, message: '{rem.message}'")
+        shown += 1
+    if shown == 0:
+        if offset == 0:
+            print("you don't have any active reminders right now.")
+        else:
+            print("no reminders at that offset.")
 
 # ----------------------------------------------------------------------------
-# the remove command, used to remove an active reminder
+# the find command, used to search the active reminders by their message
+# aliases: /f /find
+#
+# usage: /find <terms>
+# lists the reminders with a word starting with each of the terms.
+def cmd_find(query: str):
+    if not query.strip():
+        print("error: nothing to search for")
+        return
+    rems = reminders.find(None, query)
+    for rem in rems:
+        print(f"reminder with ID {rem.job_id} -- will go off {rem.timestr}, type: {rem.type}, message: '{rem.message}'")
+    if not rems:
+        print("no reminders found.")
+
+# ----------------------------------------------------------------------------
+# the remove command, used to remove active reminders
 # aliases: /r /rm /remove
+#
+# usage: /remove <IDs> | all | match <terms>
+# <IDs> is a list of reminder IDs and ranges of them, e.g '3 5 9-20'. with
+# 'match', the reminders that /find <terms> would list are removed.
 def cmd_remove(query: str):
-    if not query or not query.isdigit():
-        print("error: invalid reminder ID")
+    try:
+        job_ids = remind.selectreminders(reminders, None, query)
+    except ValueError as e:
+        print(f"error: {e}")
+        return
+    if not job_ids:
+        print("error: no such reminders")
     else:
-        remove_job_by_id(int(query))
+        print(f"removed {remove_jobs(job_ids)} reminders.")
 
 # ----------------------------------------------------------------------------
-# the remindafter command
-# aliases: /ra /remindin /remindafter
-def cmd_remindafter(query: str):
+# helper functions used by the remind commands
+
+# parse <query> with <parse> (remind.remindafter, remind.remindat or
+# remind.remindevery).
+#
+# returns the result, or None after printing the error if it's invalid.
+def parsequery(parse, query: str):
     try:
-        reminder_time = remind.remindafter(query)
+        return parse(query)
     except ValueError as e:
+        remind.metrics.inc("parse_errors_total")
         print(f"error: {e}")
-        return
-    reminder_msg = input("enter the reminder message: ")
-    timestr = reminder_time.strftime("%c")
-    print(f"set reminder to {timestr}")
-    job_id = get_job_id()
-    reminders.append({"job": scheduler.add_job(do_remind, "date", args=[reminder_msg, job_id], run_date=reminder_time),
-                      "job_id": job_id,
-                      "type": "one-time",
-                      "timestr": f"at {timestr}",
-                      "message": reminder_msg})
+        return None
 
-# ----------------------------------------------------------------------------
-# the remindat command
-# aliases: /rt /remind /remindat
-def cmd_remindat(query: str):
+# check if a new reminder that repeats every <interval> seconds, or goes off
+# once if it's None, may be set (see remind.Quotas). with <create> False, no
+# create is used up.
+#
+# returns False after printing the reason if not.
+def admit(interval: float = None, create: bool = True) -> bool:
     try:
-        reminder_time = remind.remindat(query)
+        quotas.check(None, interval, create)
     except ValueError as e:
         print(f"error: {e}")
+        return False
+    return True
+
+BUSY_NOTE = "busy right now, so the reminder may go off late."
+
+# set a reminder that goes off once at <reminder_time>, a datetime. the
+# commands only check the quotas before asking for the message, the create is
+# used up here.
+def addonetime(reminder_time: datetime, reminder_msg: str):
+    if not admit():
         return
-    reminder_msg = input("enter the reminder message: ")
     timestr = reminder_time.strftime("%c")
     print(f"set reminder to {timestr}")
-    rnum = len(reminders)
-    job_id = get_job_id()
-    reminders.append({"job": scheduler.add_job(do_remind, "date", args=[reminder_msg, job_id], run_date=reminder_time),
-                      "job_id": job_id,
-                      "type": "one-time",
-                      "timestr": f"at {timestr}",
-                      "message": reminder_msg})
+    rem = remind.Reminder(reminder_msg, reminder_time.timestamp())
+    reminders.add(rem)
+    if schedule_new(rem):
+        print(BUSY_NOTE)
+
+# set a reminder that goes off every <iv>, an interval list as returned by
+# remind.remindevery
+def addrepeating(iv: list, reminder_msg: str):
+    seconds = remind.intervalseconds(iv)
+    if not admit(seconds):
+        return
+    ivstr = remind.intervalstr(iv)
+    print(f"set reminder for every {ivstr}")
+    rem = remind.Reminder(reminder_msg, time.time() + seconds, seconds)
+    reminders.add(rem)
+    if schedule_new(rem):
+        print(BUSY_NOTE)
+
+# ----------------------------------------------------------------------------
+# the remindafter command
+# aliases: /ra /remindin /remindafter
+def cmd_remindafter(query: str, reminder_msg: str = None):
+    reminder_time = parsequery(remind.remindafter, query)
+    if reminder_time is not None and admit(create=False):
+        if reminder_msg is None:
+            reminder_msg = input("enter the reminder message: ")
+        addonetime(reminder_time, reminder_msg)
+
+# ----------------------------------------------------------------------------
+# the remindat command
+# aliases: /rt /remind /remindat
+def cmd_remindat(query: str, reminder_msg: str = None):
+    reminder_time = parsequery(remind.remindat, query)
+    if reminder_time is not None and admit(create=False):
+        if reminder_msg is None:
+            reminder_msg = input("enter the reminder message: ")
+        addonetime(reminder_time, reminder_msg)
 
 # ----------------------------------------------------------------------------
 # the remindevery command
 # aliases: /re /remindevery
+def cmd_remindevery(query: str, reminder_msg: str = None):
+    iv = parsequery(remind.remindevery, query)
+    if iv is not None and not all(v == 0 for v in iv) and admit(remind.intervalseconds(iv), create=False):
+        if reminder_msg is None:
+            reminder_msg = input("enter the reminder message: ")
+        addrepeating(iv, reminder_msg)
 
-# helper function used by cmd_remindevery -- convert an interval list to a
-# string description
-def intervalstr(interval: list) -> str:
-    s = ""
-    if interval[0] > 0:
-        s += f"{interval[0]} weeks, "
-    if interval[1] > 0:
-        s += f"{interval[1]} days, "
-    if interval[2] > 0:
-        s += f"{interval[2]} hours, "
-    if interval[3] > 0:
-        s += f"{interval[3]} minutes, "
-    if interval[4] > 0:
-        s += f"{interval[4]} seconds, "
-    return s[:-2]
-
-def cmd_remindevery(query: str):
+# ----------------------------------------------------------------------------
+# the import command, used to import reminders from a file
+# usage: /import <path>
+# the format is taken from the file extension (.csv, .jsonl or .ics).
+def cmd_import(query: str):
+    fmt = remind_io.fileformat(query)
+    if fmt is None:
+        print("error: unknown file format, use .csv, .jsonl or .ics")
+        return
+    # each imported reminder uses up a create, see quotas.trim
+    if not admit(create=False):
+        return
+    count = 0
     try:
-        iv = remind.remindevery(query)
-    except ValueError as e:
+        with open(query, encoding="utf-8", newline="") as f:
+            for rems, errors in remind_io.importreminders(f, fmt):
+                rems, over = quotas.trim(None, rems)
+                reminders.add_many(rems)
+                for rem in rems:
+                    schedule_new(rem)
+                count += len(rems)
+                for row, error in errors:
+                    print(f"error: row {row}: {error}")
+                for error in over:
+                    print(f"error: {error}")
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"error: {e}")
+    print(f"imported {count} reminders.")
+
+# ----------------------------------------------------------------------------
+# the export command, used to export reminders to a file
+# usage: /export <path>
+# the format is taken from the file extension (.csv, .jsonl or .ics).
+def cmd_export(query: str):
+    fmt = remind_io.fileformat(query)
+    if fmt is None:
+        print("error: unknown file format, use .csv, .jsonl or .ics")
+        return
+    try:
+        with open(query, "w", encoding="utf-8", newline="") as f:
+            f.writelines(remind_io.exportreminders(reminders.iter_owner(None), fmt))
+    except OSError as e:
         print(f"error: {e}")
         return
-    if not all(v == 0 for v in iv):
-        reminder_msg = input("enter the reminder message: ")
-        ivstr = intervalstr(iv)
-        print(f"set reminder for every {ivstr}")
-        job_id = get_job_id()
-        reminders.append({"job": scheduler.add_job(do_remind, "interval", args=[reminder_msg, -1], weeks=iv[0], days=iv[1], hours=iv[2], minutes=iv[3], seconds=iv[4]),
-                          "job_id": job_id,
-                          "type": "repeating",
-                          "timestr": f"every {ivstr}",
-                          "message": reminder_msg})
+    print(f"exported {len(reminders)} reminders.")
+
+# ----------------------------------------------------------------------------
+# the stats command, used to show metrics
+def cmd_stats():
+    print(remind.metrics.summary())
+
+# ----------------------------------------------------------------------------
+# daemon mode: python cli_frontend.py --daemon
+#
+# instead of reading commands from the terminal, the daemon takes them from
+# remind_client.py over a Unix domain socket (see remind_client.py for the
+# protocol and the socket's path), so reminders keep going off after the
+# terminal is closed and commands don't pay for starting up. reminders are
+# printed to the daemon's output and sent to the clients running 'watch'.
+
+# clients running 'watch', as (socket, file) pairs
+watchers = set()
+
+def notify_watchers(line: str):
+    for watcher in list(watchers):
+        sock, f = watcher
+        try:
+            f.write(json.dumps({"output": line}) + "\n")
+            f.flush()
+        except OSError:
+            # gone, or too slow to keep up
+            watchers.discard(watcher)
+
+# the daemon's stdout. while a client's command runs, its handler thread
+# writes to a stream of its own, so the command's output goes back to the
+# client without holding up what the other threads print, e.g reminders
+# going off.
+class ThreadStdout:
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self._local = threading.local()
+
+    # send what the current thread prints to <stream> inside the block
+    @contextlib.contextmanager
+    def capture(self, stream):
+        self._local.stream = stream
+        try:
+            yield stream
+        finally:
+            self._local.stream = None
+
+    def _target(self):
+        stream = getattr(self._local, "stream", None)
+        return self.stdout if stream is None else stream
+
+    # the file interface used by print()
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+daemon_stdout = None
+
+# held while running a client's command, so commands run one at a time
+command_lock = threading.Lock()
+
+# run a command from a client. output goes to stdout.
+def run_command(argv: list):
+    name, args = argv[0], argv[1:]
+    if name in ("add", "at", "every"):
+        if len(args) < 2:
+            print(f"error: usage: {name} <time> <message>")
+            return
+        cmd = {"add": cmd_remindafter, "at": cmd_remindat, "every": cmd_remindevery}[name]
+        cmd(args[0], " ".join(args[1:]))
+    elif name in ("ls", "list"):
+        cmd_list(" ".join(args))
+    elif name in ("rm", "remove"):
+        cmd_remove(" ".join(args))
+    elif name == "find":
+        cmd_find(" ".join(args))
+    elif name == "import" and len(args) == 1:
+        cmd_import(args[0])
+    elif name == "export" and len(args) == 1:
+        cmd_export(args[0])
+    elif name == "stats":
+        cmd_stats()
+    else:
+        print("error: unknown command")
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def reply(self, **msg):
+        self.wfile.write(json.dumps(msg).encode() + b"\n")
+
+    def handle(self):
+        try:
+            argv = json.loads(self.rfile.readline())["argv"]
+        except (ValueError, KeyError, TypeError):
+            self.reply(output="error: invalid request\n", status=1)
+            return
+        if not argv:
+            self.reply(status=1)
+        elif argv[0] == "watch":
+            self.watch()
+        elif argv[0] == "stop":
+            self.reply(status=0)
+            self.server.shutdown()
+        else:
+            with command_lock, daemon_stdout.capture(io.StringIO()) as out:
+                run_command(argv)
+            output = out.getvalue()
+            failed = any(line.startswith("error:") for line in output.splitlines())
+            self.reply(output=output, status=1 if failed else 0)
+
+    # stream reminders to the client until it disconnects. writes time out,
+    # so a client that stops reading can't hold up the reminders.
+    def watch(self):
+        self.connection.settimeout(1)
+        watcher = (self.connection, self.connection.makefile("w", encoding="utf-8"))
+        with output_lock:
+            watchers.add(watcher)
+        try:
+            while True:
+                try:
+                    if not self.connection.recv(1):
+                        break
+                except TimeoutError:
+                    continue
+                except OSError:
+                    break
+        finally:
+            with output_lock:
+                watchers.discard(watcher)
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def daemon():
+    path = remind_client.socketpath()
+    if os.path.exists(path):
+        try:
+            remind_client.connect(path).close()
+            print(f"error: a daemon is already running on {path}")
+            return
+        except OSError:
+            # left over from a daemon that didn't exit cleanly
+            os.remove(path)
+
+    # only the user running the daemon may connect to it
+    umask = os.umask(0o077)
+    try:
+        server = DaemonServer(path, DaemonHandler)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+
+    global daemon_stdout
+    sys.stdout = daemon_stdout = ThreadStdout(sys.stdout)
+    startup()
+    print(f"listening on {path}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        reminders.flush()
+
+# ----------------------------------------------------------------------------
+# async mode: python cli_frontend.py --async
+#
+# stdin is read without blocking by the event loop, which also runs the
+# scheduler, so everything happens in the main thread and the amount of
+# threads doesn't grow with the amount of reminders.
+
+# the terminal, as used by async mode. print()'s output has to go through it
+# (see main_async), so output that comes while a line is being typed is
+# written above the prompt, which is then drawn again with the half-typed
+# line.
+#
+# if stdin is a terminal, it's put into cbreak mode and the line is edited
+# (and echoed) here, since the terminal wouldn't let us redraw a half-typed
+# line. only backspace, ^U (clear the line) and ^D (end of input, on an
+# empty line) are supported.
+class Console:
+    def __init__(self):
+        self.prompt = ""
+        # the half-typed line
+        self.line = ""
+        # if we're waiting for a line, and the prompt is shown
+        self.reading = False
+        self._stdout = sys.stdout
+        self._fd = sys.stdin.fileno()
+        self._saved = None
+        self._lines = asyncio.Queue()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._output = ""
+        self._escape = False
+
+    def start(self):
+        if termios is not None and os.isatty(self._fd):
+            self._saved = termios.tcgetattr(self._fd)
+            tty.setcbreak(self._fd)
+        asyncio.get_running_loop().add_reader(self._fd, self._read)
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self._fd)
+        if self._saved is not None:
+            termios.tcsetattr(self._fd, termios.TCSADRAIN, self._saved)
+
+    # like input(). raises EOFError at the end of the input.
+    async def input(self, prompt: str) -> str:
+        self.prompt = prompt
+        self.reading = True
+        self._redraw()
+        try:
+            line = await self._lines.get()
+        finally:
+            self.reading = False
+        if line is None:
+            raise EOFError
+        return line
+
+    # the file interface used by print()
+    def write(self, text: str) -> int:
+        self._output += text
+        if "\n" in self._output:
+            done, self._output = self._output.rsplit("\n", 1)
+            if self._saved is not None:
+                # clear the prompt line first
+                done = "\r\x1b[K" + done
+            self._stdout.write(done + "\n")
+            self._redraw()
+        return len(text)
+
+    def flush(self):
+        self._stdout.flush()
+
+    def _redraw(self):
+        if self._saved is not None:
+            self._stdout.write("\r\x1b[K")
+            if self.reading:
+                self._stdout.write(self.prompt + self.line)
+        elif self.reading:
+            self._stdout.write(self.prompt)
+        self._stdout.flush()
+
+    def _read(self):
+        data = os.read(self._fd, 4096)
+        if not data:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            if self.line:
+                self._lines.put_nowait(self.line)
+            self._lines.put_nowait(None)
+            return
+        text = self._decoder.decode(data)
+        if self._saved is None:
+            # not a terminal, so the input comes in whole lines and isn't
+            # echoed
+            *lines, self.line = (self.line + text).split("\n")
+            for line in lines:
+                self._lines.put_nowait(line.rstrip("\r"))
+            return
+        for c in text:
+            self._key(c)
+        self._stdout.flush()
+
+    def _key(self, c: str):
+        if self._escape:
+            # skip escape sequences, e.g from the arrow keys
+            if c.isalpha() or c == "~":
+                self._escape = False
+        elif c == "\x1b":
+            self._escape = True
+        elif c in "\r\n":
+            self._stdout.write("\n")
+            self._lines.put_nowait(self.line)
+            self.line = ""
+        elif c in "\x7f\b":
+            if self.line:
+                self.line = self.line[:-1]
+                self._stdout.write("\b \b")
+        elif c == "\x15":
+            self.line = ""
+            self._redraw()
+        elif c == "\x04":
+            if not self.line:
+                self._lines.put_nowait(None)
+        elif c.isprintable():
+            self.line += c
+            self._stdout.write(c)
+
+async def main_async():
+    console = Console()
+    with contextlib.redirect_stdout(console):
+        startup()
+        console.start()
+        try:
+            while True:
+                cmd = (await console.input("enter your command: ")).split(maxsplit=1)
+                if len(cmd) == 0:
+                    continue
+                arg = cmd[1] if len(cmd) > 1 else ""
+                # the remind commands ask for the message, which has to be
+                # awaited here instead of read with input()
+                if cmd[0] == "/exit":
+                    break
+                elif cmd[0] in ["/ra", "/remindin", "/remindafter", "/rt", "/remind", "/remindat"]:
+                    parse = remind.remindafter if cmd[0] in ["/ra", "/remindin", "/remindafter"] else remind.remindat
+                    reminder_time = parsequery(parse, arg)
+                    if reminder_time is not None and admit(create=False):
+                        addonetime(reminder_time, await console.input("enter the reminder message: "))
+                elif cmd[0] in ["/re", "/remindevery"]:
+                    iv = parsequery(remind.remindevery, arg)
+                    if iv is not None and not all(v == 0 for v in iv) and admit(remind.intervalseconds(iv), create=False):
+                        addrepeating(iv, await console.input("enter the reminder message: "))
+                else:
+                    runcommand(cmd[0], arg)
+        except EOFError:
+            pass
+        finally:
+            console.close()
+            scheduler.shutdown(wait=False)
+            reminders.flush()
 
 # ----------------------------------------------------------------------------
 # the main function
-def main():
+def startup():
+    if REMIND_DB:
+        restore()
+        scheduler.add_job(job(schedule_restored), "interval", seconds=RESTORE_HORIZON / 2)
+        scheduler.add_job(job(reminders.flush), "interval", seconds=reminders.flush_interval)
+    if firecap.limit > 0:
+        scheduler.add_job(fire_deferred, "interval", seconds=firecap.tick)
+    if quotas.mode == "defer" and quotas.max_backlog > 0:
+        scheduler.add_job(admit_deferred, "interval", seconds=1)
     scheduler.start()
+    if os.getenv("REMIND_METRICS_PORT"):
+        remind.serve_metrics(int(os.getenv("REMIND_METRICS_PORT")))
+
+# run a command typed in the terminal, other than /exit
+def runcommand(name: str, arg: str):
+    if name in ["/l", "/ls", "/list"]:
+        cmd_list(arg)
+    elif name in ["/r", "/rm", "/remove"]:
+        cmd_remove(arg)
+    elif name in ["/f", "/find"]:
+        cmd_find(arg)
+    elif name in ["/ra", "/remindin", "/remindafter"]:
+        cmd_remindafter(arg)
+    elif name in ["/rt", "/remind", "/remindat"]:
+        cmd_remindat(arg)
+    elif name in ["/re", "/remindevery"]:
+        cmd_remindevery(arg)
+    elif name == "/stats":
+        cmd_stats()
+    elif name == "/import":
+        cmd_import(arg)
+    elif name == "/export":
+        cmd_export(arg)
+    else:
+        print("error: unknown command")
+
+def main():
+    if "--daemon" in sys.argv[1:]:
+        daemon()
+        return
+    if ASYNC_MODE:
+        try:
+            asyncio.run(main_async())
+        except KeyboardInterrupt:
+            pass
+        return
+    startup()
     try:
         while True:
             cmdstr = input("enter your command: ")
@@ -150,20 +843,11 @@ def main():
                 continue
             elif cmd[0] == "/exit":
                 break
-            elif cmd[0] in ["/l", "/ls", "/list"]:
-                cmd_list()
-            elif cmd[0] in ["/r", "/rm", "/remove"]:
-                cmd_remove(cmd[1])
-            elif cmd[0] in ["/ra", "/remindin", "/remindafter"]:
-                cmd_remindafter(cmd[1])
-            elif cmd[0] in ["/rt", "/remind", "/remindat"]:
-                cmd_remindat(cmd[1])
-            elif cmd[0] in ["/re", "/remindevery"]:
-                cmd_remindevery(cmd[1])
-            else:
-                print("error: unknown command")
+            runcommand(cmd[0], cmd[1] if len(cmd) > 1 else "")
     except (EOFError, KeyboardInterrupt):
-        return
+        pass
+    finally:
+        reminders.flush()
 
 if __name__ == "__main__":
     main()
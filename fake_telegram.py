@@ -0,0 +1,252 @@
+# ----------------------------------------------------------------------------
+# a fake Telegram Bot API server, for load testing the aiogram frontend
+# without a real bot token or network access.
+#
+# usage: python fake_telegram.py [--host 127.0.0.1] [--port 8081]
+#                                [--latency 0.0] [--error-rate 0.0]
+#                                [--flood-rate 0] [--chat-flood-rate 0]
+#
+# point the bot at it with REMIND_BOT_API=http://127.0.0.1:8081 (any token
+# works). updates are delivered by getUpdates, or posted to the webhook set
+# with setWebhook. every other method is recorded and answered with a
+# plausible result; sendMessage returns a Message.
+#
+# every method but getUpdates takes --latency seconds. send methods fail with
+# 429 (Too Many Requests) with a probability of --error-rate, and whenever
+# more than --flood-rate messages per second in total or --chat-flood-rate
+# per chat are sent, like Telegram's flood limits.
+#
+# loadgen.py runs this in-process, and uses push_message and the on_send
+# callback to drive and observe the bot.
+
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import random
+import time
+
+# package modules
+from aiohttp import ClientSession, ClientTimeout, web
+
+# custom modules
+import remind
+
+# ----------------------------------------------------------------------------
+# the server
+
+# methods that send a message, which the errors are injected into
+SEND_METHODS = {"sendMessage", "sendDocument", "editMessageText"}
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "remind", "username": "remind_bot"}
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0,
+                 flood_rate: float = 0.0, chat_flood_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood = remind.TokenBucket(flood_rate) if flood_rate > 0 else None
+        self.chat_flood_rate = chat_flood_rate
+        self._chat_buckets = {}
+        # called with (method, params, time) for every recorded call
+        self.on_send = None
+        # counts of calls per method, and of injected 429s
+        self.calls = collections.Counter()
+        self.errors = 0
+
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = collections.deque()
+        self._new_updates = asyncio.Event()
+        self._webhook = None
+        self._webhook_secret = None
+        self._webhook_task = None
+        self._session = None
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._webhook_task is not None:
+            self._webhook_task.cancel()
+        if self._session is not None:
+            await self._session.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # ------------------------------------------------------------------------
+    # updates
+
+    # queue an update for the bot.
+    def push_update(self, update: dict):
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._new_updates.set()
+
+    # queue a text message from a user in a private chat.
+    def push_message(self, chat_id: int, text: str):
+        self.push_update({"message": {
+            "message_id": next(self._message_ids), "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}}})
+
+    async def get_updates(self, offset: int, limit: int, timeout: float) -> list:
+        # updates before the offset were confirmed by the bot
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    # post the updates to the webhook, up to <limit> at a time, until the
+    # webhook is deleted.
+    async def deliver_webhook(self, limit: int):
+        if self._session is None:
+            self._session = ClientSession(timeout=ClientTimeout(total=60))
+        inflight = asyncio.Semaphore(limit)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self._webhook_secret} if self._webhook_secret else {}
+
+        async def post(update):
+            try:
+                async with self._session.post(self._webhook, json=update, headers=headers) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        logging.warning("webhook returned %d", resp.status)
+            except Exception as e:
+                logging.warning("webhook failed: %s", e)
+            finally:
+                inflight.release()
+
+        while True:
+            while not self._updates:
+                self._new_updates.clear()
+                await self._new_updates.wait()
+            await inflight.acquire()
+            asyncio.create_task(post(self._updates.popleft()))
+
+    # ------------------------------------------------------------------------
+    # methods
+
+    # check the flood limits and roll for an injected error.
+    #
+    # returns the retry_after of a 429 to answer with, or None.
+    def flood_check(self, chat_id) -> int:
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            return 1
+        if self.flood is not None:
+            wait = self.flood.take()
+            if wait > 0:
+                return max(1, round(wait))
+        if self.chat_flood_rate > 0 and chat_id is not None:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = remind.TokenBucket(self.chat_flood_rate)
+            wait = bucket.take()
+            if wait > 0:
+                return max(1, round(wait))
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            offset = int(params.get("offset", 0))
+            limit = int(params.get("limit", 100))
+            timeout = float(params.get("timeout", 0))
+            return self.ok(await self.get_updates(offset, limit, timeout))
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            return self.ok(BOT_USER)
+        elif method == "setWebhook":
+            self._webhook = params.get("url")
+            self._webhook_secret = params.get("secret_token")
+            if self._webhook_task is not None:
+                self._webhook_task.cancel()
+            self._webhook_task = asyncio.create_task(self.deliver_webhook(int(params.get("max_connections", 40))))
+            return self.ok(True)
+        elif method == "deleteWebhook":
+            self._webhook = None
+            if self._webhook_task is not None:
+                self._webhook_task.cancel()
+                self._webhook_task = None
+            return self.ok(True)
+
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if method in SEND_METHODS:
+            retry_after = self.flood_check(chat_id)
+            if retry_after is not None:
+                self.errors += 1
+                return web.json_response({"ok": False, "error_code": 429,
+                                          "description": f"Too Many Requests: retry after {retry_after}",
+                                          "parameters": {"retry_after": retry_after}})
+        if self.on_send is not None:
+            self.on_send(method, params, time.time())
+        if method in ("sendMessage", "sendDocument"):
+            message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+            if "text" in params:
+                message["text"] = params["text"]
+            return self.ok(message)
+        return self.ok(True)
+
+    def ok(self, result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+# ----------------------------------------------------------------------------
+# the main function
+async def serve(args):
+    api = FakeBotAPI(args.latency, args.error_rate, args.flood_rate, args.chat_flood_rate)
+
+    def log(method, params, when):
+        print(json.dumps({"time": when, "method": method, **params}), flush=True)
+
+    api.on_send = log
+    await api.start(args.host, args.port)
+    logging.info("fake Bot API listening on http://%s:%d", args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+def addarguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every method takes (default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="probability of a 429 for every sent message (default: %(default)s)")
+    parser.add_argument("--flood-rate", type=float, default=0,
+                        help="messages per second before 429s, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--chat-flood-rate", type=float, default=0,
+                        help="messages per second per chat before 429s, 0 for no limit (default: %(default)s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    addarguments(parser)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
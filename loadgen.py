@@ -0,0 +1,281 @@
+# ----------------------------------------------------------------------------
+# load generator for the aiogram frontend, run against fake_telegram.py.
+#
+# usage: python loadgen.py [--chats 1000] [--duration 60] [--think 2.0]
+#                          [--mode polling|webhook] [--bot aiogram_frontend.py]
+#                          [--port 8081] [--webhook-port 8080] [--bot-log FILE]
+#                          [--latency 0.0] [--error-rate 0.0] [--flood-rate 0]
+#                          [--chat-flood-rate 0] [--output results.json]
+#                          [--baseline old.json] [--tolerance 0.2]
+#
+# starts a fake Bot API server and the bot (any script that takes the same
+# environment as aiogram_frontend.py, e.g aiogram_shards.py) pointed at it,
+# then simulates <chats> users that each wait about <think> seconds, then
+# set a reminder with /remindafter or /remindevery, /list their reminders
+# or /remove one, and wait for the bot's answer. it runs for <duration>
+# seconds and then waits for the reminders still due.
+#
+# reported are the throughput of updates, the latency from sending an update
+# to getting the answer, and the fire lag of the reminders (from when they
+# were due to when their message was sent). results are printed, written as
+# JSON with --output and compared against --baseline like bench.py does.
+
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+
+# custom modules
+import bench
+import fake_telegram
+
+# ----------------------------------------------------------------------------
+# the simulated users
+
+# how long to wait for an answer before giving up
+ANSWER_TIMEOUT = 10.0
+
+# actions and how likely they are
+ACTIONS = ["after", "every", "list", "remove"]
+WEIGHTS = [40, 10, 30, 20]
+
+# at most this many repeating reminders per chat, so they don't pile up
+MAX_REPEATING = 3
+
+class Stats:
+    def __init__(self):
+        self.updates = 0
+        self.answers = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.latencies = []
+        self.fire_lags = []
+        # token -> due time of one-time reminders that haven't gone off yet
+        self.expected = {}
+        # token -> (first fire, interval) of repeating reminders
+        self.repeating = {}
+
+class Chat:
+    def __init__(self, chat_id: int, api: fake_telegram.FakeBotAPI, stats: Stats):
+        self.chat_id = chat_id
+        self.api = api
+        self.stats = stats
+        self.tokens = []
+        self.waiting = None
+        self._seq = itertools.count()
+
+    # send a message and wait for the answer.
+    #
+    # returns the answer, or None if there was none in time.
+    async def ask(self, text: str):
+        self.waiting = asyncio.get_running_loop().create_future()
+        sent = time.time()
+        self.api.push_message(self.chat_id, text)
+        self.stats.updates += 1
+        try:
+            answer, received = await asyncio.wait_for(self.waiting, ANSWER_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            return None
+        finally:
+            self.waiting = None
+        self.stats.answers += 1
+        self.stats.latencies.append(received - sent)
+        if answer.startswith("error:"):
+            self.stats.errors += 1
+        return answer
+
+    def answered(self, text: str, when: float):
+        if self.waiting is not None and not self.waiting.done():
+            self.waiting.set_result((text, when))
+
+    async def run(self, end: float, think: float):
+        stats = self.stats
+        while True:
+            await asyncio.sleep(random.expovariate(1 / think))
+            if time.time() >= end:
+                return
+            action = random.choices(ACTIONS, WEIGHTS)[0]
+            if action == "every" and sum(token in stats.repeating for token in self.tokens) >= MAX_REPEATING:
+                action = "remove"
+
+            if action == "after":
+                seconds = random.randint(1, 10)
+                due = time.time() + seconds
+                answer = await self.ask(f"/remindafter {seconds}s")
+                if answer is None or answer.startswith("error:"):
+                    continue
+                token = f"c{self.chat_id}r{next(self._seq)}z"
+                if await self.ask(f"load {token}") is not None:
+                    stats.expected[token] = due
+                    self.tokens.append(token)
+            elif action == "every":
+                seconds = random.randint(2, 10)
+                answer = await self.ask(f"/remindevery {seconds}s")
+                if answer is None or answer.startswith("error:"):
+                    continue
+                token = f"c{self.chat_id}r{next(self._seq)}z"
+                first = time.time() + seconds
+                if await self.ask(f"load {token}") is not None:
+                    stats.repeating[token] = (first, seconds)
+                    self.tokens.append(token)
+            elif action == "list":
+                await self.ask("/list")
+            elif self.tokens:
+                token = self.tokens.pop(random.randrange(len(self.tokens)))
+                stats.expected.pop(token, None)
+                stats.repeating.pop(token, None)
+                await self.ask(f"/remove match {token}")
+
+# record a message sent by the bot: either reminders (one per line, maybe
+# merged) or the answer to a chat's last message.
+def onsend(chats: dict, stats: Stats, method: str, params: dict, when: float):
+    if method != "sendMessage":
+        return
+    text = params.get("text", "")
+    chat = chats.get(int(params["chat_id"]))
+    if not text.startswith("REMINDER - "):
+        if chat is not None:
+            chat.answered(text, when)
+        return
+    for line in text.splitlines():
+        token = line.rsplit(" ", 1)[-1]
+        due = stats.expected.pop(token, None)
+        if due is not None and chat is not None and token in chat.tokens:
+            chat.tokens.remove(token)
+        elif token in stats.repeating:
+            first, interval = stats.repeating[token]
+            due = first + max(0, (when - first) // interval) * interval
+        if due is not None:
+            stats.fire_lags.append(when - due)
+
+# ----------------------------------------------------------------------------
+# the bot
+
+def botenv(args) -> dict:
+    env = dict(os.environ, BOT_TOKEN="123456:loadgen", REMIND_BOT_API=f"http://127.0.0.1:{args.port}",
+               REMIND_MODE=args.mode)
+    if args.mode == "webhook":
+        env["REMIND_WEBHOOK_PORT"] = str(args.webhook_port)
+        env["REMIND_WEBHOOK_URL"] = f"http://127.0.0.1:{args.webhook_port}/webhook"
+    return env
+
+# wait until the bot is getting updates. raises RuntimeError if it exits
+# first.
+async def waitready(api: fake_telegram.FakeBotAPI, proc, timeout: float = 60.0):
+    end = time.time() + timeout
+    while api.calls["getUpdates"] == 0 and api.calls["setWebhook"] == 0:
+        if proc.returncode is not None:
+            raise RuntimeError(f"the bot exited with status {proc.returncode}")
+        if time.time() > end:
+            raise RuntimeError("the bot didn't start in time")
+        await asyncio.sleep(0.1)
+
+async def stopbot(proc):
+    if proc.returncode is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), 20)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+# ----------------------------------------------------------------------------
+# the main function
+
+async def run(args):
+    api = fake_telegram.FakeBotAPI(args.latency, args.error_rate, args.flood_rate, args.chat_flood_rate)
+    stats = Stats()
+    chats = {chat_id: Chat(chat_id, api, stats) for chat_id in range(1, args.chats + 1)}
+    api.on_send = lambda method, params, when: onsend(chats, stats, method, params, when)
+    await api.start("127.0.0.1", args.port)
+
+    log = open(args.bot_log, "w") if args.bot_log else subprocess.DEVNULL
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.bot)
+    proc = await asyncio.create_subprocess_exec(sys.executable, *shlex.split(script), env=botenv(args),
+                                                stdout=log, stderr=subprocess.STDOUT)
+    try:
+        await waitready(api, proc)
+        print(f"running {args.chats} chats for {args.duration}s", file=sys.stderr)
+        start = time.time()
+        end = start + args.duration
+        await asyncio.gather(*(chat.run(end, args.think) for chat in chats.values()))
+        elapsed = time.time() - start
+
+        # wait for the reminders that are still due
+        drain_end = time.time() + 15
+        while stats.expected and time.time() < drain_end:
+            await asyncio.sleep(0.5)
+    finally:
+        await stopbot(proc)
+        await api.stop()
+        if log is not subprocess.DEVNULL:
+            log.close()
+
+    bench.record("load.updates_per_second", stats.updates / elapsed, "updates/s", "higher")
+    if stats.latencies:
+        for p in (0.5, 0.9, 0.99):
+            bench.record(f"load.latency_p{round(p * 100)}", bench.percentile(stats.latencies, p), "s", "lower")
+        bench.record("load.latency_max", max(stats.latencies), "s", "lower")
+    bench.record("load.timeouts", stats.timeouts, "updates", "lower")
+    bench.record("load.error_answers", stats.errors, "updates", "lower")
+    if stats.fire_lags:
+        for p in (0.5, 0.9, 0.99):
+            bench.record(f"load.fire_lag_p{round(p * 100)}", bench.percentile(stats.fire_lags, p), "s", "lower")
+        bench.record("load.fire_lag_max", max(stats.fire_lags), "s", "lower")
+    bench.record("load.reminders_fired", len(stats.fire_lags), "reminders", "higher")
+    bench.record("load.reminders_missed", len(stats.expected), "reminders", "lower")
+    bench.record("load.injected_429s", api.errors, "requests", "lower")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="load test the aiogram frontend against a fake Bot API server")
+    parser.add_argument("--chats", type=int, default=1000, help="simulated chats (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run for (default: %(default)s)")
+    parser.add_argument("--think", type=float, default=2.0,
+                        help="mean seconds between a chat's actions (default: %(default)s)")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--bot", default="aiogram_frontend.py",
+                        help="the bot's script and its arguments (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8081, help="port of the fake Bot API (default: %(default)s)")
+    parser.add_argument("--webhook-port", type=int, default=8080,
+                        help="port of the bot's webhook (default: %(default)s)")
+    parser.add_argument("--bot-log", help="write the bot's output to this file")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression against the baseline (default: %(default)s)")
+    fake_telegram.addarguments(parser)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except RuntimeError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "time": datetime.now().isoformat(), "results": bench.results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if bench.compare(baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
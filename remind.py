@@ -2,8 +2,26 @@
 # modules
 from datetime import datetime, timedelta
 
+import array
+import asyncio
+import bisect
+import collections
+import functools
+import http.server
+import heapq
+import itertools
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
 # ----------------------------------------------------------------------------
 # constants
+logger = logging.getLogger("remind")
+
 SECONDS = ["s", "sec", "secs", "second", "seconds"]
 MINUTES = ["m", "min", "mins", "minute", "minutes"]
 HOURS   = ["h", "hr",  "hrs",  "hour",   "hours"]
@@ -18,73 +36,78 @@ TIME_UNITS = [
         "w", "wk",  "wks",  "week",   "weeks"
 ]
 
-# ----------------------------------------------------------------------------
-# helper function for adding time to a datetime
-def addtime(time: datetime, amount: int, unit: str) -> datetime:
-    t = time
-    if unit in SECONDS:
-        t += timedelta(seconds=amount)
-    elif unit in MINUTES:
-        t += timedelta(minutes=amount)
-    elif unit in HOURS:
-        t += timedelta(hours=amount)
-    elif unit in DAYS:
-        t += timedelta(days=amount)
-    elif unit in WEEKS:
-        t += timedelta(weeks=amount)
-    return t
-
-# ----------------------------------------------------------------------------
-# helper function for adding time to an interval, used by remindevery
-def addinterval(interval: list, amount: int, unit: str) -> list:
-    i = interval[:]
-    if unit in SECONDS:
-        i[4] += amount
-    elif unit in MINUTES:
-        i[3] += amount
-    elif unit in HOURS:
-        i[2] += amount
-    elif unit in DAYS:
-        i[1] += amount
-    elif unit in WEEKS:
-        i[0] += amount
-    return i
+# maps every time unit to its index in a duration tuple, which is in the
+# format of (weeks, days, hours, minutes, seconds).
+UNITS = {unit: index for index, units in enumerate([WEEKS, DAYS, HOURS, MINUTES, SECONDS])
+         for unit in units}
 
 # ----------------------------------------------------------------------------
-# usage: remindafter <time>
-# <time> can be in short format ('10s') or long format ('10 sec' or '10 seconds')
+# duration parser, used by remindafter and remindevery.
 #
-# returns a datetime object at which the reminder should fire.
+# a duration is one or more '<amount><unit>' or '<amount> <unit>' pairs
+# separated by spaces, e.g '5m 10 seconds'. the query is scanned in one pass
+# with a precompiled regex and units are looked up in the UNITS dict.
+#
+# results are cached by the query with its whitespace normalized, since the
+# same few durations ('10m', '1h') are parsed over and over.
+DURATION_CACHE_SIZE = 1024
+
+_duration_token = re.compile(r"(\d+) ?([a-z]+)(?: |$)")
+
+@functools.lru_cache(maxsize=DURATION_CACHE_SIZE)
+def _parseduration(query: str) -> tuple:
+    duration = [0, 0, 0, 0, 0]
+    match = _duration_token.match
+    pos, end = 0, len(query)
+    while pos < end:
+        m = match(query, pos)
+        if m is None:
+            raise ValueError("invalid time format")
+        unit = UNITS.get(m.group(2))
+        if unit is None:
+            raise ValueError("invalid time format")
+        duration[unit] += int(m.group(1))
+        pos = m.end()
+    return tuple(duration)
+
+# parse a duration.
+#
+# returns a tuple in the format of (weeks, days, hours, minutes, seconds).
 # raises ValueError on error.
-def remindafter(query: str) -> datetime:
+def parseduration(query: str) -> tuple:
     if not query:
         raise ValueError("bad query")
-    args = query.split()
-    now = datetime.now()
-    if len(args) < 1:
+    normalized = " ".join(query.split())
+    if not normalized:
         raise ValueError("bad query")
+    return _parseduration(normalized)
 
-    i = 0
-    remaining = len(args)
+# ----------------------------------------------------------------------------
+# the latest time a reminder can go off at, as a unix timestamp. datetime
+# doesn't go past the year 9999, and this leaves a day of room for jitter and
+# time zones.
+MAX_TIMESTAMP = datetime(9999, 12, 31).timestamp()
 
-    while remaining > 0:
-        if remaining == 1 or (remaining > 1 and args[i + 1] not in TIME_UNITS):
-            if args[i][:-1].isdigit() and args[i][-1] in TIME_UNITS:
-                now = addtime(now, int(args[i][:-1]), args[i][-1])
-                remaining -= 1
-                i += 1
-            else:
-                raise ValueError("invalid time format")
-        elif remaining >= 2:
-            if args[i].isdigit() and args[i + 1] in TIME_UNITS:
-                now = addtime(now, int(args[i]), args[i + 1])
-                remaining -= 2
-                i += 2
-            else:
-                raise ValueError("invalid time format")
-        else:
-            raise ValueError("invalid time format")
-    return now
+# ----------------------------------------------------------------------------
+# usage: remindafter <time>
+# <time> can be in short format ('10s') or long format ('10 sec' or '10 seconds')
+#
+# the reminder is relative to <now>, or the current time if it's None.
+#
+# returns a datetime object at which the reminder should fire.
+# raises ValueError on error.
+def remindafter(query: str, now: datetime = None) -> datetime:
+    weeks, days, hours, minutes, seconds = parseduration(query)
+    if now is None:
+        now = datetime.now()
+    try:
+        then = now + timedelta(weeks=weeks, days=days, hours=hours,
+                               minutes=minutes, seconds=seconds)
+    except OverflowError:
+        raise ValueError("invalid time format")
+    if then.timestamp() > MAX_TIMESTAMP:
+        raise ValueError("invalid time format")
+    return then
 
 # ----------------------------------------------------------------------------
 # helper functions for remindat
@@ -117,16 +140,18 @@ def parsetime(time: list) -> list:
 # isn't in the past. '08/15 18:30:00' will remind you
 # at 6:30 PM on August 15 of this year, '08/15' will remind you on
 # August 15 at the same time as right now.
+# "right now" is <now>, or the current time if it's None.
 #
 # returns a datetime object at which the reminder should fire.
 # raises ValueError on error.
-def remindat(query: str) -> datetime:
+def remindat(query: str, now: datetime = None) -> datetime:
     if not query:
         raise ValueError("bad query")
     args = query.split()
     if len(args) < 1 or len(args) > 2:
         raise ValueError("bad query")
-    now = datetime.now()
+    if now is None:
+        now = datetime.now()
     year, month, day = now.year, now.month, now.day
     hour, minute, second = now.hour, now.minute, now.second
 
@@ -153,7 +178,6 @@ def remindat(query: str) -> datetime:
     except ValueError:
         raise ValueError("invalid time format")
 
-    now = datetime.now()
     if not seendate:
         year, month, day = now.year, now.month, now.day
     if not seentime:
@@ -176,32 +200,1635 @@ def remindat(query: str) -> datetime:
 # returns a list in the format of [weeks, days, hours, minutes, seconds].
 # raises ValueError on error.
 def remindevery(query: str, cmdname: str = "remindevery") -> list:
-    if not query:
-        raise ValueError("bad query")
-    args = query.split()
-    interval = [0, 0, 0, 0, 0]
-    if len(args) < 1:
-        raise ValueError("bad query")
+    interval = list(parseduration(query))
+    # the first fire has to be a time we can schedule
+    remindafter(query)
+    return interval
+
+# ----------------------------------------------------------------------------
+# convert an interval list as returned by remindevery to seconds.
+def intervalseconds(interval: list) -> int:
+    return (interval[0] * 604800 + interval[1] * 86400 + interval[2] * 3600
+            + interval[3] * 60 + interval[4])
+
+# get the next time a repeating reminder that first fired (or will first
+# fire) at <first> fires, that is not before <now>. all times are unix
+# timestamps.
+def nextfire(first: float, interval: float, now: float) -> float:
+    if first >= now:
+        return first
+    return first + math.ceil((now - first) / interval) * interval
+
+# ----------------------------------------------------------------------------
+# batch parsing, for creating lots of reminders at once.
+
+# error codes returned by parse_many
+PARSE_OK             = 0
+PARSE_BAD_QUERY      = 1
+PARSE_INVALID_FORMAT = 2
+PARSE_IN_PAST        = 3
+
+# error messages of the error codes, as raised by the parsers
+PARSE_MESSAGES = {
+        PARSE_BAD_QUERY: "bad query",
+        PARSE_INVALID_FORMAT: "invalid time format",
+        PARSE_IN_PAST: "date/time cannot be in the past"
+}
+
+_parse_errors = {message: code for code, message in PARSE_MESSAGES.items()}
+
+# parse one query for parse_many. returns a (value, error code) pair.
+# durations whose (first) fire is past MAX_TIMESTAMP are invalid, like in
+# remindafter.
+def _parse_one(query: str, kind: str, now: datetime, now_ts: float) -> tuple:
+    try:
+        if kind == "at":
+            return remindat(query, now).timestamp(), PARSE_OK
+        seconds = intervalseconds(parseduration(query))
+        if now_ts + seconds > MAX_TIMESTAMP:
+            return 0.0, PARSE_INVALID_FORMAT
+        return (now_ts + seconds if kind == "after" else float(seconds)), PARSE_OK
+    except ValueError as e:
+        return 0.0, _parse_errors.get(str(e), PARSE_INVALID_FORMAT)
+    except OverflowError:
+        return 0.0, PARSE_INVALID_FORMAT
+
+# parse many queries of the same kind at once, all relative to the same <now>
+# (a datetime, or the current time if it's None). <kind> is one of "after",
+# "at" or "every", for remindafter, remindat and remindevery queries.
+#
+# instead of raising an exception for a bad query, its error code (one of the
+# PARSE_* constants) is set and its value is 0. identical queries are only
+# parsed once per call.
+#
+# returns a (values, errors) pair of arrays. for "after" and "at", the values
+# are unix timestamps at which the reminders should fire; for "every", they
+# are intervals in seconds. the arrays are array.array('d') and
+# array.array('b'), or NumPy arrays if <use_numpy> is True (this requires
+# NumPy to be installed).
+def parse_many(queries, kind: str = "after", now: datetime = None, use_numpy: bool = False) -> tuple:
+    if kind not in ("after", "at", "every"):
+        raise ValueError(f"unknown query kind '{kind}'")
+    if now is None:
+        now = datetime.now()
+    now_ts = now.timestamp()
+
+    values, errors = array.array("d"), array.array("b")
+    add_value, add_error = values.append, errors.append
+    seen = {}
+    for query in queries:
+        result = seen.get(query)
+        if result is None:
+            result = seen[query] = _parse_one(query, kind, now, now_ts)
+        add_value(result[0])
+        add_error(result[1])
+
+    if use_numpy:
+        import numpy
+        return numpy.frombuffer(values, dtype=numpy.float64), numpy.frombuffer(errors, dtype=numpy.int8)
+    return values, errors
+
+# ----------------------------------------------------------------------------
+# split an interval in seconds into a list in the format of
+# [weeks, days, hours, minutes, seconds], like remindevery returns.
+def splitinterval(seconds: float) -> list:
+    seconds = int(seconds)
+    weeks, seconds = divmod(seconds, 604800)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return [weeks, days, hours, minutes, seconds]
+
+# convert an interval list to a string description
+def intervalstr(interval: list) -> str:
+    s = ""
+    if interval[0] > 0:
+        s += f"{interval[0]} weeks, "
+    if interval[1] > 0:
+        s += f"{interval[1]} days, "
+    if interval[2] > 0:
+        s += f"{interval[2]} hours, "
+    if interval[3] > 0:
+        s += f"{interval[3]} minutes, "
+    if interval[4] > 0:
+        s += f"{interval[4]} seconds, "
+    return s[:-2]
+
+# ----------------------------------------------------------------------------
+# a reminder.
+#
+# only what's needed to deliver and reschedule a reminder is stored: the
+# message, the chat (or other owner) and message to reply to, the time it
+# fires next at and, for repeating reminders, the interval in seconds.
+# "job_id" and "owner" are set by the store, "job" is the reminder's scheduler
+# job, if it has one. descriptions for listing are only built when needed.
+#
+# for repeating reminders, "next_fire" is the time of the first fire; the
+# actual next fire is computed from it with nextfire().
+#
+# "jitter" is how many seconds after its time the reminder is scheduled to
+# go off, to spread out reminders that are due at the same time (see
+# jitterfor). it is set when the reminder is added to a store with a spread
+# and stored with it, so it doesn't change on restarts.
+class Reminder:
+    __slots__ = ("job_id", "owner", "reply_to", "message", "next_fire", "interval", "jitter", "job")
+
+    def __init__(self, message: str, next_fire: float, interval: float = None, reply_to: int = None,
+                 jitter: float = 0.0):
+        self.job_id = None
+        self.owner = None
+        self.reply_to = reply_to
+        self.message = message
+        self.next_fire = next_fire
+        self.interval = interval
+        self.jitter = jitter
+        self.job = None
+
+    @property
+    def type(self) -> str:
+        return "one-time" if self.interval is None else "repeating"
+
+    # get the time the fire that is happening at <now> was scheduled for
+    def due(self, now: float) -> float:
+        if self.interval is None or now < self.next_fire:
+            return self.next_fire
+        return self.next_fire + (now - self.next_fire) // self.interval * self.interval
+
+    # get the time the reminder is scheduled to (first) go off at
+    @property
+    def fire_at(self) -> float:
+        return self.next_fire + self.jitter
 
-    i = 0
-    remaining = len(args)
+    # description of when the reminder goes off, e.g 'every 10 seconds'
+    @property
+    def timestr(self) -> str:
+        if self.interval is None:
+            return "at " + datetime.fromtimestamp(self.next_fire).strftime("%c")
+        return "every " + intervalstr(splitinterval(self.interval))
 
-    while remaining > 0:
-        if remaining == 1 or (remaining > 1 and args[i + 1] not in TIME_UNITS):
-            if args[i][:-1].isdigit() and args[i][-1] in TIME_UNITS:
-                interval = addinterval(interval, int(args[i][:-1]), args[i][-1])
-                remaining -= 1
-                i += 1
+# ----------------------------------------------------------------------------
+# full-text index of reminder messages, used by ReminderStore.find.
+#
+# every owner has its own postings, mapping each token (a lowercased word) of
+# its reminders' messages to the IDs of the reminders that contain it. a
+# search term matches every token it is a prefix of, which are next to each
+# other in a sorted list of the owner's tokens, so a search only looks at the
+# matching tokens of one owner instead of every message.
+#
+# an owner's postings are only built, in one go, when it is first searched;
+# until then, adds and removals for it are ignored, so filling or loading a
+# store costs nothing extra. after that, adding and removing only touch the
+# postings. the sorted list is built on the next search and kept until a
+# token is added or dropped. most tokens are in only one message, so their
+# postings are that ID alone instead of a set.
+TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text: str) -> set:
+    return set(TOKEN_RE.findall(text.casefold()))
+
+class SearchIndex:
+    def __init__(self):
+        # owner -> {token: ID, or set of IDs}, for the owners that were
+        # searched
+        self._postings = {}
+        # owner -> sorted list of tokens, if it is up to date
+        self._sorted = {}
+
+    def __contains__(self, owner) -> bool:
+        return owner in self._postings
+
+    # build the postings of <owner> from (ID, text) pairs of all of its
+    # reminders.
+    def build(self, owner, entries):
+        self._postings[owner] = {}
+        self._sorted.pop(owner, None)
+        for job_id, text in entries:
+            self.add(owner, job_id, text)
+
+    def add(self, owner, job_id: int, text: str):
+        postings = self._postings.get(owner)
+        if postings is None:
+            return
+        for token in TOKEN_RE.findall(text.casefold()):
+            ids = postings.get(token)
+            if ids is None:
+                postings[token] = job_id
+                self._sorted.pop(owner, None)
+            elif type(ids) is int:
+                if ids != job_id:
+                    postings[token] = {ids, job_id}
             else:
-                raise ValueError("invalid time format")
-        elif remaining >= 2:
-            if args[i].isdigit() and args[i + 1] in TIME_UNITS:
-                interval = addinterval(interval, int(args[i + 1]), args[i + 1])
-                now = addtime(now, int(args[i]), args[i + 1])
-                remaining -= 2
-                i += 2
+                ids.add(job_id)
+
+    def remove(self, owner, job_id: int, text: str):
+        postings = self._postings.get(owner)
+        if postings is None:
+            return
+        for token in tokenize(text):
+            ids = postings.get(token)
+            if ids is None:
+                continue
+            if type(ids) is int:
+                if ids == job_id:
+                    del postings[token]
+                    self._sorted.pop(owner, None)
+                continue
+            ids.discard(job_id)
+            if len(ids) == 1:
+                postings[token] = next(iter(ids))
+
+    # forget the postings of an owner that has no reminders left.
+    def drop(self, owner):
+        self._postings.pop(owner, None)
+        self._sorted.pop(owner, None)
+
+    # get the IDs of an owner's reminders with a token starting with <prefix>.
+    def prefixed(self, owner, prefix: str) -> set:
+        postings = self._postings.get(owner)
+        if postings is None:
+            return set()
+        tokens = self._sorted.get(owner)
+        if tokens is None:
+            tokens = self._sorted[owner] = sorted(postings)
+        ids = set()
+        for i in range(bisect.bisect_left(tokens, prefix), len(tokens)):
+            if not tokens[i].startswith(prefix):
+                break
+            found = postings[tokens[i]]
+            if type(found) is int:
+                ids.add(found)
             else:
-                raise ValueError("invalid time format")
+                ids |= found
+        return ids
+
+    # get the IDs of an owner's reminders that match every term of <query>.
+    def search(self, owner, query: str) -> set:
+        ids = None
+        # longer terms usually match fewer reminders, so start with them to
+        # keep the intersection small
+        for term in sorted(tokenize(query), key=len, reverse=True):
+            matches = self.prefixed(owner, term)
+            ids = matches if ids is None else ids & matches
+            if not ids:
+                break
+        return ids or set()
+
+# ----------------------------------------------------------------------------
+# parse a list of reminder IDs and ranges of them, e.g '3 5 9-20', as taken
+# by the remove commands.
+#
+# returns a list of (first, last) pairs, with first == last for single IDs.
+# raises ValueError if the list is invalid.
+def parseids(query: str) -> list:
+    ranges = []
+    for part in query.replace(",", " ").split():
+        first, sep, last = part.partition("-")
+        if not first.isdigit() or (sep and not last.isdigit()):
+            raise ValueError(f"invalid reminder ID '{part}'")
+        first = int(first)
+        last = int(last) if sep else first
+        if last < first:
+            raise ValueError(f"invalid range '{part}'")
+        ranges.append((first, last))
+    if not ranges:
+        raise ValueError("invalid reminder ID")
+    return ranges
+
+# get the IDs of an owner's reminders in <store> that the <query> of a remove
+# command refers to: 'all' of them, the ones that 'match <terms>' (like
+# ReminderStore.find) or a list of IDs and ranges of them (see parseids).
+# raises ValueError if the query is invalid.
+def selectreminders(store, owner, query: str) -> list:
+    query = query.strip()
+    if query == "all":
+        return [rem.job_id for rem in store.by_owner(owner)]
+    elif query == "match" or query.startswith(("match ", "match\t")):
+        terms = query[len("match"):]
+        if not terms.strip():
+            raise ValueError("nothing to match")
+        return [rem.job_id for rem in store.find(owner, terms)]
+    return store.select(owner, parseids(query))
+
+# ----------------------------------------------------------------------------
+# get a jitter of [0, <spread>) seconds for a reminder of <owner>. it only
+# depends on the owner, message and time of the reminder, so it is the same
+# every time, but reminders that are due at the same time are spread evenly
+# over <spread> seconds.
+def jitterfor(rem: Reminder, owner, spread: float) -> float:
+    if spread <= 0:
+        return 0.0
+    key = f"{owner}:{rem.next_fire!r}:{rem.message}".encode()
+    return zlib.crc32(key) / 2 ** 32 * spread
+
+# ----------------------------------------------------------------------------
+# reminder store, shared by the frontends.
+#
+# reminders are kept in a dict indexed by their ID, with a secondary index
+# of IDs per owner (e.g a chat ID). freed IDs are kept in a min-heap, so the
+# lowest free ID is always reused first, like the old linear scan did.
+# adding, looking up and removing a reminder are O(1) or O(log n).
+# messages are kept in a SearchIndex for find(). with a <spread> of more
+# than 0, added reminders get a jitter of up to <spread> seconds.
+#
+# all mutation happens under a lock, so the store can be shared between
+# scheduler threads and the main thread. the lock is never held across an
+# await, so it is also safe to use from asyncio code.
+class ReminderStore:
+    def __init__(self, spread: float = 0.0):
+        self.spread = spread
+        self._lock = threading.RLock()
+        self._reminders = {}
+        self._owners = {}
+        self._free_ids = []
+        self._next_id = 0
+        self._repeating = 0
+        self._index = SearchIndex()
+
+    def __len__(self) -> int:
+        return len(self._reminders)
+
+    # get the amount of reminders by type.
+    def counts(self) -> dict:
+        return {"one-time": len(self._reminders) - self._repeating, "repeating": self._repeating}
+
+    def __contains__(self, job_id: int) -> bool:
+        return job_id in self._reminders
+
+    # iterate over all reminders in the order they were added. this iterates over a
+    # snapshot, so the store may be modified while iterating.
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._reminders.values()))
+
+    # allocate an ID, reusing the lowest freed one if there is one.
+    def _new_id(self) -> int:
+        if self._free_ids:
+            return heapq.heappop(self._free_ids)
+        job_id = self._next_id
+        self._next_id += 1
+        return job_id
+
+    # add a reminder to the store. the reminder's job_id and owner are set by
+    # the store.
+    #
+    # returns the ID of the new reminder.
+    def add(self, reminder: Reminder, owner=None) -> int:
+        with self._lock:
+            job_id = self._new_id()
+            reminder.job_id = job_id
+            reminder.owner = owner
+            if self.spread > 0:
+                reminder.jitter = jitterfor(reminder, owner, self.spread)
+            self._reminders[job_id] = reminder
+            if reminder.interval is not None:
+                self._repeating += 1
+            self._owners.setdefault(owner, {})[job_id] = None
+            self._index.add(owner, job_id, reminder.message)
+            return job_id
+
+    # get a reminder by its ID, or None if there is no such reminder.
+    def get(self, job_id: int):
+        return self._reminders.get(job_id)
+
+    # add many reminders of the same owner at once, taking the lock only once.
+    def add_many(self, reminders: list, owner=None):
+        with self._lock:
+            for reminder in reminders:
+                self.add(reminder, owner)
+
+    # remove a reminder by its ID and free the ID for reuse.
+    #
+    # returns the removed reminder, or None if there was no such reminder.
+    def remove(self, job_id: int):
+        with self._lock:
+            rem = self._reminders.pop(job_id, None)
+            if rem is None:
+                return None
+            owned = self._owners[rem.owner]
+            del owned[job_id]
+            if not owned:
+                del self._owners[rem.owner]
+                self._index.drop(rem.owner)
+            if rem.interval is not None:
+                self._repeating -= 1
+            self._index.remove(rem.owner, job_id, rem.message)
+            heapq.heappush(self._free_ids, job_id)
+            return rem
+
+    # remove many reminders by their IDs at once, taking the lock only once.
+    #
+    # returns the removed reminders.
+    def remove_many(self, job_ids) -> list:
+        with self._lock:
+            removed = []
+            for job_id in job_ids:
+                rem = self.remove(job_id)
+                if rem is not None:
+                    removed.append(rem)
+            return removed
+
+    # get the IDs of an owner's reminders that are in one of <ranges>, a list
+    # of (first, last) pairs of IDs as returned by parseids. a range is looked
+    # up ID by ID if it's smaller than the amount of reminders the owner has,
+    # otherwise the owner's reminders are checked against it.
+    def select(self, owner, ranges: list) -> list:
+        with self._lock:
+            owned = self._owners.get(owner, {})
+            ids = set()
+            for first, last in ranges:
+                if last - first < len(owned):
+                    ids.update(job_id for job_id in range(first, last + 1) if job_id in owned)
+                else:
+                    ids.update(job_id for job_id in owned if first <= job_id <= last)
+            return sorted(ids)
+
+    # get all reminders of an owner, in the order they were added.
+    def by_owner(self, owner) -> list:
+        with self._lock:
+            return [self._reminders[job_id] for job_id in self._owners.get(owner, ())]
+
+    # iterate over the reminders of an owner in the order they were added,
+    # starting at the <offset>th one, and at most <limit> of them if it isn't
+    # None. only the owner's reminders are looked at. the reminders (up to
+    # <limit>) are taken once up front and checked <chunk> at a time under
+    # the lock, so the store may be modified while iterating: reminders
+    # removed in the meantime are skipped, and ones added aren't seen.
+    def iter_owner(self, owner, offset: int = 0, chunk: int = 100, limit: int = None):
+        with self._lock:
+            stop = None if limit is None else offset + limit
+            owned = itertools.islice(self._owners.get(owner, ()), offset, stop)
+            snapshot = [self._reminders[job_id] for job_id in owned]
+        for start in range(0, len(snapshot), chunk):
+            with self._lock:
+                rems = [rem for rem in snapshot[start:start + chunk]
+                        if self._reminders.get(rem.job_id) is rem]
+            yield from rems
+
+    # find the reminders of an owner whose message has a word starting with
+    # each of the words in <query>, e.g 'doc app' finds 'doctor's appointment'.
+    # returns them sorted by ID.
+    def find(self, owner, query: str) -> list:
+        with self._lock:
+            owned = self._owners.get(owner)
+            if owned is None:
+                return []
+            if owner not in self._index:
+                self._index.build(owner, ((job_id, self._reminders[job_id].message) for job_id in owned))
+            return [self._reminders[job_id] for job_id in sorted(self._index.search(owner, query))]
+
+    # get the amount of reminders an owner has.
+    def count(self, owner) -> int:
+        return len(self._owners.get(owner, ()))
+
+    # write out pending changes. the in-memory store has nothing to write.
+    def flush(self):
+        pass
+
+# ----------------------------------------------------------------------------
+# persistent reminder store, backed by a local SQLite database.
+#
+# the whole store is still kept in memory; the database is only written to,
+# except when restoring with load(). adds and removals are queued and
+# written in one transaction once <batch_size> changes are pending or
+# <flush_interval> seconds have passed since the last write, so creating
+# lots of reminders doesn't cost a commit each. call flush() periodically
+# and before exiting to write out the rest.
+#
+# since repeating reminders store the time of their first fire, firing a
+# reminder doesn't need any writes. every flush also records the time it
+# happened, so load() can tell when we last ran (see last_seen).
+#
+# the schema is versioned: 1 replaced the type and description columns of
+# the first version with reply_to, 2 added jitter.
+SCHEMA_VERSION = 2
+
+REMINDERS_TABLE = """CREATE TABLE {name} (
+                         id INTEGER PRIMARY KEY,
+                         owner,
+                         reply_to INTEGER,
+                         message TEXT NOT NULL,
+                         next_fire REAL NOT NULL,
+                         interval REAL,
+                         jitter REAL NOT NULL DEFAULT 0)"""
+
+class SQLiteReminderStore(ReminderStore):
+    def __init__(self, path: str, batch_size: int = 1000, flush_interval: float = 1.0, spread: float = 0.0):
+        super().__init__(spread)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._migrate()
+        self._db.execute("CREATE INDEX IF NOT EXISTS reminders_next_fire ON reminders (next_fire)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self._db.commit()
+        self._added = {}
+        self._removed = set()
+        self._last_flush = time.monotonic()
+        # the unix timestamp of the last flush before load(), or None if it
+        # isn't known
+        self.last_seen = None
+
+    # create the reminders table, or bring one from an older version up to
+    # SCHEMA_VERSION, which is kept in PRAGMA user_version. databases from
+    # before it was kept there are told apart by their columns.
+    def _migrate(self):
+        if self._db.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            return
+        # sqlite3 doesn't open a transaction for DDL on its own
+        self._db.execute("BEGIN")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(reminders)")]
+        if not columns:
+            self._db.execute(REMINDERS_TABLE.format(name="reminders"))
+        elif "timestr" in columns:
+            # the first version stored the type and description instead of
+            # the message to reply to. SQLite can't drop columns everywhere,
+            # so the table is copied.
+            self._db.execute(REMINDERS_TABLE.format(name="reminders_new"))
+            self._db.execute("""INSERT INTO reminders_new (id, owner, message, next_fire, interval)
+                                SELECT id, owner, message, next_fire, interval FROM reminders""")
+            self._db.execute("DROP TABLE reminders")
+            self._db.execute("ALTER TABLE reminders_new RENAME TO reminders")
+        elif "jitter" not in columns:
+            self._db.execute("ALTER TABLE reminders ADD COLUMN jitter REAL NOT NULL DEFAULT 0")
+        self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def add(self, reminder: Reminder, owner=None) -> int:
+        with self._lock:
+            job_id = super().add(reminder, owner)
+            self._added[job_id] = reminder
+            self._maybe_flush()
+            return job_id
+
+    def remove(self, job_id: int):
+        with self._lock:
+            rem = super().remove(job_id)
+            if rem is not None:
+                self._added.pop(job_id, None)
+                self._removed.add(job_id)
+                self._maybe_flush()
+            return rem
+
+    # like add() and remove(), but only check whether to flush once at the
+    # end, so a big batch isn't written out piece by piece.
+    def add_many(self, reminders: list, owner=None):
+        with self._lock:
+            for reminder in reminders:
+                self._added[super().add(reminder, owner)] = reminder
+            self._maybe_flush()
+
+    def remove_many(self, job_ids) -> list:
+        with self._lock:
+            removed = []
+            for job_id in job_ids:
+                rem = super().remove(job_id)
+                if rem is not None:
+                    self._added.pop(job_id, None)
+                    self._removed.add(job_id)
+                    removed.append(rem)
+            self._maybe_flush()
+            return removed
+
+    def _maybe_flush(self):
+        if (len(self._added) + len(self._removed) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    # write out all pending adds and removals in one transaction.
+    # removals are written first, since a removed ID may have been reused.
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            with self._db:
+                if self._removed:
+                    self._db.executemany("DELETE FROM reminders WHERE id = ?",
+                                         [(job_id,) for job_id in self._removed])
+                if self._added:
+                    self._db.executemany("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         [(job_id, rem.owner, rem.reply_to, rem.message, rem.next_fire, rem.interval,
+                                           rem.jitter)
+                                          for job_id, rem in self._added.items()])
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('last_seen', ?)", (time.time(),))
+            self._added.clear()
+            self._removed.clear()
+
+    # restore all reminders from the database in one bulk read. this should be
+    # called once, on startup, before adding any reminders. the restored
+    # reminders don't have a job yet; schedule them with due_between().
+    #
+    # returns the amount of restored reminders.
+    def load(self) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'last_seen'").fetchone()
+            self.last_seen = row[0] if row else None
+            rows = self._db.execute("SELECT id, owner, reply_to, message, next_fire, interval, jitter "
+                                    "FROM reminders ORDER BY id").fetchall()
+            reminders, owners = self._reminders, self._owners
+            for job_id, owner, reply_to, message, next_fire, interval, jitter in rows:
+                rem = reminders[job_id] = Reminder(message, next_fire, interval, reply_to, jitter)
+                rem.job_id = job_id
+                rem.owner = owner
+                owned = owners.get(owner)
+                if owned is None:
+                    owned = owners[owner] = {}
+                owned[job_id] = None
+                if interval is not None:
+                    self._repeating += 1
+            if rows:
+                self._next_id = rows[-1][0] + 1
+                self._free_ids = [job_id for job_id in range(self._next_id) if job_id not in reminders]
+                heapq.heapify(self._free_ids)
+            return len(rows)
+
+    # get all reminders that (first) fire at or after the unix timestamp
+    # <start> and before <end>, using the index on next_fire. pending changes
+    # are written out first.
+    def due_between(self, start: float, end: float) -> list:
+        with self._lock:
+            self.flush()
+            rows = self._db.execute("SELECT id FROM reminders WHERE next_fire >= ? AND next_fire < ?", (start, end)).fetchall()
+            return [self._reminders[row[0]] for row in rows if row[0] in self._reminders]
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._db.close()
+
+# ----------------------------------------------------------------------------
+# catching up on reminders that should have gone off while we weren't
+# running, e.g after restoring them with SQLiteReminderStore.load().
+#
+# what happens to a reminder that missed fires depends on the policy:
+# - "once": it goes off once, no matter how many fires it missed.
+# - "all": it goes off once for every fire it missed.
+# - "skip": it doesn't go off.
+# - "coalesce": it's listed in a summary, one per owner, instead of going off.
+# one-time reminders are removed from the store once they're handled.
+# repeating reminders still have to be scheduled as usual, only the fires up
+# to the time of the restore are handled here.
+#
+# missed fires aren't handled right away, but at most <limit> at a time by
+# step(), which should be called periodically (e.g by a scheduler job), so a
+# big backlog doesn't hold up startup or flood the output.
+MISFIRE_POLICIES = ("once", "all", "skip", "coalesce")
+
+# reminders per summary message
+SUMMARY_LINES = 50
+
+# count the fires of a reminder after <since> and at or before <now>. if
+# <since> is None (we don't know when we last ran), repeating reminders are
+# taken to have missed nothing.
+def missedfires(rem: Reminder, since: float, now: float) -> int:
+    if rem.interval is None:
+        return 1 if rem.next_fire <= now else 0
+    if since is None or now < rem.next_fire:
+        return 0
+    last = (now - rem.next_fire) // rem.interval
+    first = 0 if since < rem.next_fire else (since - rem.next_fire) // rem.interval + 1
+    return max(0, int(last - first + 1))
+
+class CatchUp:
+    # <fire>(reminder) makes a reminder go off, <notify>(owner, text) sends a
+    # summary to an owner. <repeating_policy> is the policy for repeating
+    # reminders, the same as <policy> if it's None.
+    def __init__(self, store: ReminderStore, fire, notify, policy: str = "once", repeating_policy: str = None):
+        if repeating_policy is None:
+            repeating_policy = policy
+        for p in (policy, repeating_policy):
+            if p not in MISFIRE_POLICIES:
+                raise ValueError(f"unknown misfire policy '{p}'")
+        self.store = store
+        self.fire = fire
+        self.notify = notify
+        self.policy = policy
+        self.repeating_policy = repeating_policy
+        self._lock = threading.Lock()
+        # ("fire", reminder, count) and ("notify", owner, text) tuples
+        self._pending = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    # plan the catch-up of the reminders in <rems>, restored at <now> after
+    # we last ran at <since>.
+    def add(self, rems, since: float, now: float):
+        summaries = {}
+        skipped = 0
+        with self._lock:
+            for rem in rems:
+                count = missedfires(rem, since, now)
+                if count == 0:
+                    continue
+                policy = self.policy if rem.interval is None else self.repeating_policy
+                if policy == "once":
+                    self._pending.append(("fire", rem, 1))
+                elif policy == "all":
+                    self._pending.append(("fire", rem, count))
+                else:
+                    if policy == "coalesce":
+                        line = f"- {rem.message} ({rem.timestr}"
+                        line += f", missed {count} times)" if count > 1 else ")"
+                        summaries.setdefault(rem.owner, []).append(line)
+                    else:
+                        skipped += count
+                    if rem.interval is None:
+                        self.store.remove(rem.job_id)
+            for owner, lines in summaries.items():
+                for i in range(0, len(lines), SUMMARY_LINES):
+                    text = "\n".join(["missed while offline:"] + lines[i:i + SUMMARY_LINES])
+                    self._pending.append(("notify", owner, text))
+        metrics.inc("missed_fires_skipped_total", skipped)
+
+    # handle up to <limit> missed fires and summaries.
+    #
+    # returns how many are left.
+    def step(self, limit: int) -> int:
+        work = []
+        with self._lock:
+            while self._pending and len(work) < limit:
+                kind, target, count = self._pending.popleft()
+                if kind == "fire":
+                    n = min(count, limit - len(work))
+                    if n < count:
+                        self._pending.appendleft((kind, target, count - n))
+                    work.extend([(kind, target, None)] * n)
+                else:
+                    work.append((kind, target, count))
+            left = len(self._pending)
+
+        for kind, target, text in work:
+            if kind == "notify":
+                self.notify(target, text)
+                metrics.inc("missed_summaries_total")
+            # reminders that were removed in the meantime don't go off
+            elif self.store.get(target.job_id) is target:
+                self.fire(target)
+                metrics.inc("missed_fires_total")
+                if target.interval is None:
+                    self.store.remove(target.job_id)
+        return left
+
+# ----------------------------------------------------------------------------
+# metrics.
+#
+# counters, histograms and gauges are kept in a Metrics registry; remind
+# records into the module-level one, <metrics>, and so do the frontends.
+# recording takes a lock and, for histograms, a binary search over the
+# buckets, so it's cheap enough to leave on.
+#
+# the registry can be rendered in the Prometheus text format, and served on
+# localhost with serve_metrics().
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # estimate the <q> quantile (0-1) as the upper bound of the bucket it's in.
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    # add <amount> to a counter.
+    def inc(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # record a value (e.g a latency in seconds) in a histogram.
+    def observe(self, name: str, value: float):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.counts[bisect.bisect_left(BUCKETS, value)] += 1
+            hist.sum += value
+            hist.count += 1
+
+    # register a gauge. <func> is called whenever the metrics are read, and
+    # returns a number or a dict of label values to numbers.
+    def gauge(self, name: str, func):
+        self.gauges[name] = func
+
+    def _gauges(self) -> dict:
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception:
+                logger.exception("error reading gauge %s", name)
+        return values
+
+    # render the metrics in the Prometheus text format.
+    def prometheus(self, prefix: str = "remind_") -> str:
+        lines = []
+        with self._lock:
+            for name, value in self.counters.items():
+                lines.append(f"# TYPE {prefix}{name} counter")
+                lines.append(f"{prefix}{name} {value}")
+            for name, hist in self.histograms.items():
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}{name}_bucket{{le="+Inf"}} {hist.count}')
+                lines.append(f"{prefix}{name}_sum {hist.sum}")
+                lines.append(f"{prefix}{name}_count {hist.count}")
+        for name, value in self._gauges().items():
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            if isinstance(value, dict):
+                for label, v in value.items():
+                    lines.append(f'{prefix}{name}{{type="{label}"}} {v}')
+            else:
+                lines.append(f"{prefix}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    # summarize the metrics in a human readable form, for /stats.
+    def summary(self) -> str:
+        lines = []
+        for name, value in self._gauges().items():
+            if isinstance(value, dict):
+                value = ", ".join(f"{v} {label}" for label, v in value.items())
+            lines.append(f"{name}: {value}")
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name}: {value:g}")
+            for name, hist in sorted(self.histograms.items()):
+                if hist.count:
+                    lines.append(f"{name}: {hist.count} recorded, mean {hist.sum / hist.count:.3f}, "
+                                 f"p50 <= {hist.quantile(0.5):g}, p99 <= {hist.quantile(0.99):g}")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+# serve the metrics in the Prometheus text format at http://<host>:<port>/metrics
+# from a background thread.
+#
+# returns the server; call shutdown() on it to stop it.
+def serve_metrics(port: int, host: str = "127.0.0.1", registry: Metrics = None):
+    registry = metrics if registry is None else registry
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="remind-metrics", daemon=True).start()
+    return server
+
+# ----------------------------------------------------------------------------
+# reminder scheduler, an alternative to APScheduler for lots of reminders.
+#
+# instead of a job object with its own trigger per reminder, timers are kept
+# in one min-heap ordered by fire time. removing a timer only marks it as
+# cancelled; cancelled timers are dropped when they reach the top of the heap,
+# or all at once when they make up more than half of it.
+#
+# all timers that are due when the scheduler wakes up are fired in the same
+# wakeup. with a <slack> of more than 0, wakeups are rounded up to the next
+# multiple of <slack> seconds, so timers due close together share a wakeup at
+# the cost of firing up to <slack> seconds late.
+#
+# add_job() takes the same arguments as APScheduler's for the "date" and
+# "interval" triggers, and returns a timer with a remove() method like an
+# APScheduler job, so the frontends can use either. the scheduler itself
+# doesn't run anything; ThreadReminderScheduler and AsyncioReminderScheduler
+# drive it from a thread and from an asyncio event loop.
+
+class Timer:
+    __slots__ = ("scheduler", "func", "args", "when", "interval", "cancelled")
+
+    def __init__(self, scheduler, func, args, when: float, interval: float):
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.when = when
+        self.interval = interval
+        self.cancelled = False
+
+    # cancel the timer. does nothing if it already fired or was cancelled.
+    def remove(self):
+        self.scheduler._cancel(self)
+
+# convert a datetime (or a unix timestamp) to a unix timestamp.
+def _timestamp(t) -> float:
+    if isinstance(t, datetime):
+        return t.timestamp()
+    return float(t)
+
+class ReminderScheduler:
+    def __init__(self, slack: float = 0.0):
+        self.slack = slack
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._live = 0
+        self._stale = 0
+
+    # get the amount of timers that haven't fired or been cancelled yet.
+    def __len__(self) -> int:
+        return self._live
+
+    # add a timer. <trigger> is "date" to fire once at <run_date>, or
+    # "interval" to fire every <weeks>, <days>, ... starting at
+    # <next_run_time>, or one interval from now. times can be datetimes or
+    # unix timestamps.
+    #
+    # returns the timer.
+    def add_job(self, func, trigger: str = "date", args=(), run_date=None, next_run_time=None,
+                weeks=0, days=0, hours=0, minutes=0, seconds=0) -> Timer:
+        if trigger == "date":
+            interval = None
+            when = time.time() if run_date is None else _timestamp(run_date)
+        elif trigger == "interval":
+            interval = weeks * 604800 + days * 86400 + hours * 3600 + minutes * 60 + seconds
+            if interval <= 0:
+                raise ValueError("interval must be positive")
+            when = time.time() + interval if next_run_time is None else _timestamp(next_run_time)
         else:
-            raise ValueError("invalid time format")
-    return interval
+            raise ValueError(f"unknown trigger '{trigger}'")
+
+        timer = Timer(self, func, tuple(args), when, interval)
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._seq), timer))
+            self._live += 1
+            if self._heap[0][2] is timer:
+                self._wake()
+        return timer
+
+    def _cancel(self, timer: Timer):
+        with self._lock:
+            if timer.cancelled:
+                return
+            timer.cancelled = True
+            self._live -= 1
+            self._stale += 1
+            if self._stale > 64 and self._stale > self._live:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._stale = 0
+
+    # get the time of the next wakeup, or None if there are no timers.
+    # the lock has to be held.
+    def _next_wakeup(self):
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._stale -= 1
+        if not heap:
+            return None
+        when = heap[0][0]
+        if self.slack > 0:
+            when = math.ceil(when / self.slack) * self.slack
+        return when
+
+    # pop all timers that are due at <now> and rearm the repeating ones.
+    # repeating timers that missed fires only fire once.
+    # the lock has to be held.
+    #
+    # returns the timers that should be fired.
+    def _pop_due(self, now: float) -> list:
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            when, _, timer = heapq.heappop(heap)
+            if timer.cancelled:
+                self._stale -= 1
+                continue
+            due.append(timer)
+            if timer.interval is None:
+                timer.cancelled = True
+                self._live -= 1
+            else:
+                timer.when = when + timer.interval
+                if timer.when <= now:
+                    timer.when = nextfire(timer.when, timer.interval, now)
+                    if timer.when <= now:
+                        timer.when += timer.interval
+                heapq.heappush(heap, (timer.when, next(self._seq), timer))
+        return due
+
+    # fire timers. the lock must not be held.
+    def _run(self, due: list):
+        for timer in due:
+            try:
+                self._call(timer)
+            except Exception:
+                logger.exception("error in reminder job %r", timer.func)
+
+    def _call(self, timer: Timer):
+        timer.func(*timer.args)
+
+    # wake up the driver because the next wakeup changed.
+    # the lock has to be held.
+    def _wake(self):
+        pass
+
+# ----------------------------------------------------------------------------
+# reminder scheduler driven by a background thread, for the CLI frontend.
+# jobs run in the scheduler thread, one after another.
+class ThreadReminderScheduler(ReminderScheduler):
+    def __init__(self, slack: float = 0.0):
+        super().__init__(slack)
+        self._cond = threading.Condition(self._lock)
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._main, name="remind-scheduler", daemon=True)
+        self._thread.start()
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if wait and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _wake(self):
+        self._cond.notify()
+
+    def _main(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    now = time.time()
+                    wakeup = self._next_wakeup()
+                    if wakeup is not None and wakeup <= now:
+                        break
+                    self._cond.wait(None if wakeup is None else wakeup - now)
+                due = self._pop_due(now)
+            self._run(due)
+
+# ----------------------------------------------------------------------------
+# reminder scheduler driven by an asyncio task, for the aiogram frontend.
+# start() has to be called from a running event loop. jobs that are coroutine
+# functions run as separate tasks, so a slow job doesn't hold up the others.
+class AsyncioReminderScheduler(ReminderScheduler):
+    def __init__(self, slack: float = 0.0):
+        super().__init__(slack)
+        self._loop = None
+        self._event = None
+        self._task = None
+        self._tasks = set()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._task = self._loop.create_task(self._main())
+
+    def shutdown(self, wait: bool = True):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _wake(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def _main(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                wakeup = self._next_wakeup()
+                due = self._pop_due(now) if wakeup is not None and wakeup <= now else None
+            if due is not None:
+                self._run(due)
+                await asyncio.sleep(0)
+                continue
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), None if wakeup is None else wakeup - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def _call(self, timer: Timer):
+        result = timer.func(*timer.args)
+        if asyncio.iscoroutine(result):
+            task = self._loop.create_task(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("error in reminder job", exc_info=task.exception())
+
+# ----------------------------------------------------------------------------
+# shared timers for repeating reminders.
+#
+# repeating reminders with the same interval whose fires line up are put in
+# a group that has one "interval" job in <scheduler> (APScheduler or a
+# ReminderScheduler) for all of them, instead of one job each. fires are
+# lined up by rounding the first fire up to a multiple of <granularity>
+# seconds, so reminders fire up to <granularity> seconds late.
+#
+# the job calls <func> with the group, which is iterated for the reminders
+# that are due; <func> has to fire each of them. it should be a coroutine
+# function when the scheduler runs jobs in an event loop. adding and
+# removing a reminder is O(1), and the job is removed with the group's last
+# reminder.
+
+class TimerGroup:
+    def __init__(self, interval: float, phase: float, granularity: float):
+        self.interval = interval
+        self.phase = phase
+        self.granularity = granularity
+        self.members = {}
+        self.job = None
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    # iterate over the reminders that are due, i.e all but the ones whose
+    # first fire is still to come.
+    def __iter__(self):
+        now = time.time() + self.granularity
+        for rem in list(self.members.values()):
+            if rem.fire_at <= now:
+                yield rem
+
+# the "job" of a reminder in a group, so that removing it works like
+# removing a scheduler job.
+class SharedTimer:
+    __slots__ = ("timers", "group", "job_id")
+
+    def __init__(self, timers, group: TimerGroup, job_id: int):
+        self.timers = timers
+        self.group = group
+        self.job_id = job_id
+
+    def remove(self):
+        self.timers._remove(self)
+
+class SharedTimers:
+    def __init__(self, scheduler, func, granularity: float = 1.0):
+        self.scheduler = scheduler
+        self.func = func
+        self.granularity = granularity
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    # get the amount of groups, which is the amount of scheduler jobs.
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    # add a repeating reminder to its group, creating the group's job if it
+    # is the first one.
+    #
+    # returns the reminder's SharedTimer.
+    def add(self, rem: Reminder) -> SharedTimer:
+        first = math.ceil(rem.fire_at / self.granularity) * self.granularity
+        key = (rem.interval, first % rem.interval)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = TimerGroup(rem.interval, key[1], self.granularity)
+                next_fire = nextfire(key[1], rem.interval, time.time())
+                group.job = self.scheduler.add_job(self.func, "interval", args=[group], seconds=rem.interval,
+                                                   next_run_time=datetime.fromtimestamp(next_fire))
+            group.members[rem.job_id] = rem
+        return SharedTimer(self, group, rem.job_id)
+
+    def _remove(self, timer: SharedTimer):
+        group = timer.group
+        with self._lock:
+            if group.members.pop(timer.job_id, None) is None or group.members:
+                return
+            del self._groups[(group.interval, group.phase)]
+            job, group.job = group.job, None
+        job.remove()
+
+# ----------------------------------------------------------------------------
+# cap on how many reminders are fired per tick.
+#
+# jobs call the FireCap with a reminder instead of firing it with <fire>
+# themselves. at most <limit> reminders are fired per <tick> seconds; the
+# rest wait in a queue, in the order they went off, and are fired by step(),
+# which has to run every tick. that way a spike of reminders that are due
+# at the same time is spread over the next ticks, and shows up as fire lag
+# instead of saturating the event loop. a <limit> of 0 means no cap.
+class FireCap:
+    def __init__(self, fire, limit: int = 0, tick: float = 1.0):
+        self.fire = fire
+        self.limit = limit
+        self.tick = tick
+        self._deferred = collections.deque()
+        self._tick = None
+        self._left = limit
+        self._lock = threading.Lock()
+
+    # get the amount of reminders waiting for a later tick.
+    def __len__(self) -> int:
+        return len(self._deferred)
+
+    def __call__(self, rem: Reminder):
+        with self._lock:
+            self._refill()
+            now = self.limit <= 0 or (self._left > 0 and not self._deferred)
+            if now:
+                self._left -= 1
+            else:
+                self._deferred.append(rem)
+                metrics.inc("fires_deferred_total")
+        if now:
+            self.fire(rem)
+
+    # fire as many of the waiting reminders as this tick allows.
+    def step(self):
+        with self._lock:
+            self._refill()
+            n = min(self._left, len(self._deferred))
+            self._left -= n
+            due = [self._deferred.popleft() for _ in range(n)]
+        for rem in due:
+            self.fire(rem)
+
+    # start a new tick if the last one is over. the lock has to be held.
+    def _refill(self):
+        tick = math.floor(time.time() / self.tick)
+        if tick != self._tick:
+            self._tick = tick
+            self._left = self.limit
+
+# ----------------------------------------------------------------------------
+# per-owner quotas and admission control for new reminders, so one owner
+# can't take up the scheduler and the outbound sends of everyone else.
+#
+# an owner of <store> may have at most <max_reminders> reminders, repeating
+# reminders may repeat at most every <min_interval> seconds, and an owner
+# may set <create_rate> reminders per second, in bursts of <create_burst>
+# (or at least one). limits of 0 mean no limit.
+#
+# the frontend's <backlog>() is the amount of fires waiting to go out (e.g
+# in the delivery queue). while it is over <max_backlog>, the bot is busy:
+# new reminders are refused with the "reject" <mode>, or accepted but only
+# scheduled once the backlog is down again with "defer" (see defer() and
+# step(), which should be called periodically).
+BACKPRESSURE_MODES = ("reject", "defer")
+
+class Quotas:
+    def __init__(self, store: ReminderStore, max_reminders: int = 0, min_interval: float = 0,
+                 create_rate: float = 0, create_burst: float = None, backlog=None, max_backlog: int = 0,
+                 mode: str = "reject"):
+        if mode not in BACKPRESSURE_MODES:
+            raise ValueError(f"unknown backpressure mode '{mode}'")
+        self.store = store
+        self.max_reminders = max_reminders
+        self.min_interval = min_interval
+        self.create_rate = create_rate
+        self.create_burst = create_burst
+        self.backlog = backlog
+        self.max_backlog = max_backlog
+        self.mode = mode
+        self._buckets = {}
+        self._deferred = collections.deque()
+        self._lock = threading.Lock()
+
+    # get the amount of reminders waiting to be scheduled.
+    def __len__(self) -> int:
+        return len(self._deferred)
+
+    def busy(self) -> bool:
+        return self.max_backlog > 0 and self.backlog is not None and self.backlog() > self.max_backlog
+
+    # get the create rate limit of <owner>. must be called with the lock held.
+    def _bucket(self, owner) -> "TokenBucket":
+        bucket = self._buckets.get(owner)
+        if bucket is None:
+            # drop the buckets of idle owners once in a while
+            if len(self._buckets) >= 4096:
+                self._buckets = {o: b for o, b in self._buckets.items() if not b.full()}
+            burst = self.create_burst or max(1.0, self.create_rate)
+            bucket = self._buckets[owner] = TokenBucket(self.create_rate, burst)
+        return bucket
+
+    # check if <owner> may set a reminder that repeats every <interval>
+    # seconds, or goes off once if it's None. this uses up one of the
+    # owner's creates, unless <create> is False: commands that still have to
+    # ask for the message check again with <create> when the reminder is
+    # added, and imports are charged per reminder by trim().
+    #
+    # raises ValueError with the reason if not.
+    def check(self, owner, interval: float = None, create: bool = True):
+        if self.mode == "reject" and self.busy():
+            metrics.inc("backpressure_rejections_total")
+            raise ValueError("too busy right now, try again later")
+        if interval is not None and interval < self.min_interval:
+            metrics.inc("quota_rejections_total")
+            raise ValueError("reminders can't repeat more often than every "
+                             + intervalstr(splitinterval(self.min_interval)))
+        if self.room(owner) <= 0:
+            metrics.inc("quota_rejections_total")
+            raise ValueError(f"you can't have more than {self.max_reminders} reminders")
+        if self.create_rate > 0:
+            with self._lock:
+                bucket = self._bucket(owner)
+                wait = bucket.take() if create else bucket.wait()
+            if wait > 0:
+                metrics.inc("quota_rejections_total")
+                raise ValueError(f"you're setting reminders too fast, try again in {math.ceil(wait)} seconds")
+
+    # get how many more reminders <owner> may have.
+    def room(self, owner) -> float:
+        if self.max_reminders <= 0:
+            return math.inf
+        return self.max_reminders - self.store.count(owner)
+
+    # drop the reminders that <owner> may not have from <rems>, which are
+    # about to be added: the repeating ones that repeat too often, the ones
+    # over the owner's limit and the ones the owner has no creates left for.
+    # the rest use up a create each.
+    #
+    # returns the rest and a list of errors.
+    def trim(self, owner, rems: list) -> tuple:
+        errors = []
+        kept = [rem for rem in rems if rem.interval is None or rem.interval >= self.min_interval]
+        if len(kept) < len(rems):
+            errors.append(f"{len(rems) - len(kept)} reminders repeat more often than every "
+                          + intervalstr(splitinterval(self.min_interval)))
+        room = max(0, self.room(owner))
+        if len(kept) > room:
+            errors.append(f"{len(kept) - room} reminders are over the limit of {self.max_reminders}")
+            kept = kept[:room]
+        if self.create_rate > 0 and kept:
+            with self._lock:
+                bucket = self._bucket(owner)
+                taken = bucket.take_upto(len(kept))
+                wait = bucket.wait()
+            if taken < len(kept):
+                errors.append(f"{len(kept) - taken} reminders were set too fast, "
+                              f"try again in {math.ceil(wait)} seconds")
+                kept = kept[:taken]
+        if errors:
+            metrics.inc("quota_rejections_total", len(rems) - len(kept))
+        return kept, errors
+
+    # check if a reminder that was just added should be deferred instead of
+    # scheduled, and if so, defer it.
+    #
+    # returns True if it was deferred.
+    def defer(self, rem: Reminder) -> bool:
+        if self.mode != "defer" or not self.busy():
+            return False
+        with self._lock:
+            self._deferred.append(rem)
+        metrics.inc("deferred_reminders_total")
+        return True
+
+    # schedule up to <limit> deferred reminders with <schedule>, unless the
+    # bot is still busy. reminders that were removed in the meantime are
+    # dropped.
+    #
+    # returns the amount of reminders that are still deferred.
+    def step(self, schedule, limit: int = 100) -> int:
+        work = []
+        with self._lock:
+            if not self.busy():
+                while self._deferred and len(work) < limit:
+                    work.append(self._deferred.popleft())
+            left = len(self._deferred)
+        for rem in work:
+            if self.store.get(rem.job_id) is rem:
+                schedule(rem)
+        return left
+
+# ----------------------------------------------------------------------------
+# token bucket, used for rate limiting. holds up to <capacity> tokens and gains
+# <rate> tokens per second.
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # take a token if there is one.
+    #
+    # returns 0 if a token was taken, or else how many seconds it takes until
+    # one is available.
+    def take(self) -> float:
+        wait = self.wait()
+        if wait == 0:
+            self.tokens -= 1
+        return wait
+
+    # take up to <n> tokens, as many as there are.
+    #
+    # returns how many were taken.
+    def take_upto(self, n: int) -> int:
+        self._refill(time.monotonic())
+        taken = min(n, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    # get how many seconds it takes until a token is available, or 0 if there
+    # is one.
+    def wait(self) -> float:
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    # check if the bucket is full, i.e it hasn't been used in a while.
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+# ----------------------------------------------------------------------------
+# outbound message queue with rate limiting and per-chat batching.
+#
+# put() queues a message for a chat. a chat's messages are sent <window>
+# seconds after the first one was queued, merged into as few messages as
+# possible (up to MAX_MESSAGE_LENGTH characters each), so lots of reminders
+# firing at once for the same chat become one message.
+#
+# <workers> tasks send the messages with the <send> coroutine function, which
+# is called as send(chat_id, text, reply_to). a message that isn't merged with
+# others is sent as a reply to the message ID it was queued with, if any;
+# merged messages aren't replies. sends are limited to <rate> per second in
+# total and <chat_rate> per second per chat; a chat that is over its limit is
+# requeued instead of holding up a worker.
+#
+# if a send raises, <retry_delay> is called as retry_delay(exception, attempt)
+# and returns how many seconds to wait before trying again, or None to give
+# up. the default retries any error with exponential backoff. a message is
+# dropped (and logged) after <max_retries> retries.
+MAX_MESSAGE_LENGTH = 4096
+
+def default_retry_delay(exc: Exception, attempt: int) -> float:
+    return min(2 ** attempt, 60)
+
+class DeliveryQueue:
+    def __init__(self, send, rate: float = 30, chat_rate: float = 1, window: float = 1.0,
+                 workers: int = 8, max_retries: int = 5, retry_delay=default_retry_delay):
+        self.send = send
+        self.window = window
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.chat_rate = chat_rate
+        self._bucket = TokenBucket(rate)
+        self._chat_buckets = {}
+        self._pending = {}
+        self._queued = set()
+        self._queue = None
+        self._loop = None
+        self._tasks = []
+        self._sending = 0
+
+    # start the workers. has to be called from a running event loop.
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._tasks = [self._loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    # get the amount of messages that haven't been sent yet.
+    def __len__(self) -> int:
+        return sum(len(texts) for texts in self._pending.values()) + self._sending
+
+    # queue a message. this doesn't block, so it can be called from scheduler
+    # jobs. has to be called from the event loop's thread, after start().
+    def put(self, chat_id: int, text: str, reply_to: int = None):
+        texts = self._pending.get(chat_id)
+        if texts is None:
+            texts = self._pending[chat_id] = []
+        texts.append((text, reply_to, time.monotonic()))
+        if chat_id not in self._queued:
+            self._queued.add(chat_id)
+            self._loop.call_later(self.window, self._queue.put_nowait, chat_id)
+
+    # wait until all queued messages are sent (or <timeout> seconds passed),
+    # then stop the workers.
+    async def drain(self, timeout: float = None):
+        try:
+            await asyncio.wait_for(self._wait_empty(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("dropping %d undelivered messages", len(self))
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _wait_empty(self):
+        while self._pending or self._sending:
+            await asyncio.sleep(0.05)
+
+    # merge (text, reply_to, time queued) tuples into as few messages as
+    # possible.
+    #
+    # returns a list of (text, reply_to) pairs.
+    @staticmethod
+    def merge(texts: list) -> list:
+        if len(texts) == 1 and len(texts[0][0]) <= MAX_MESSAGE_LENGTH:
+            return [texts[0][:2]]
+        messages = []
+        current = []
+        length = 0
+        for text, _, _ in texts:
+            for i in range(0, len(text), MAX_MESSAGE_LENGTH):
+                part = text[i:i + MAX_MESSAGE_LENGTH]
+                if current and length + 1 + len(part) > MAX_MESSAGE_LENGTH:
+                    messages.append(("\n".join(current), None))
+                    current, length = [], 0
+                length += len(part) + (1 if current else 0)
+                current.append(part)
+        if current:
+            messages.append(("\n".join(current), None))
+        return messages
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # drop the buckets of idle chats once in a while, so they don't
+            # pile up
+            if len(self._chat_buckets) >= 4096:
+                self._chat_buckets = {c: b for c, b in self._chat_buckets.items() if not b.full()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._queue.get()
+            wait = self._chat_bucket(chat_id).take()
+            if wait > 0:
+                self._loop.call_later(wait, self._queue.put_nowait, chat_id)
+                continue
+            self._queued.discard(chat_id)
+            texts = self._pending.pop(chat_id, [])
+            messages = self.merge(texts)
+            self._sending += len(texts)
+            try:
+                for i, (text, reply_to) in enumerate(messages):
+                    if i > 0:
+                        await self._take(self._chat_bucket(chat_id))
+                    await self._send(chat_id, text, reply_to)
+            finally:
+                self._sending -= len(texts)
+            now = time.monotonic()
+            for _, _, queued in texts:
+                metrics.observe("delivery_latency_seconds", now - queued)
+
+    # wait until a token can be taken from a bucket.
+    async def _take(self, bucket: TokenBucket):
+        wait = bucket.take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = bucket.take()
+
+    async def _send(self, chat_id: int, text: str, reply_to: int):
+        attempt = 0
+        while True:
+            await self._take(self._bucket)
+            try:
+                await self.send(chat_id, text, reply_to)
+                metrics.inc("messages_sent_total")
+                return
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    logger.error("dropping message to chat %s: %s", chat_id, e)
+                    metrics.inc("messages_dropped_total")
+                    return
+                metrics.inc("send_retries_total")
+                attempt += 1
+                await asyncio.sleep(delay)
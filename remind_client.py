@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# ----------------------------------------------------------------------------
+# modules
+
+# builtin modules
+import json
+import os
+import socket
+import sys
+
+# ----------------------------------------------------------------------------
+# thin client for the remind daemon (python cli_frontend.py --daemon).
+#
+# usage: remind_client.py <command> [arguments...]
+# e.g:   remind_client.py add 10m tea
+#        remind_client.py every "1h 30m" stretch
+#        remind_client.py ls
+#
+# the command is sent to the daemon over the Unix domain socket at
+# REMIND_SOCKET (default: $XDG_RUNTIME_DIR/remind.sock, or
+# /tmp/remind-<uid>.sock), and its output is printed. the exit status is 0 if
+# the command worked, 1 if it failed and 2 if the daemon couldn't be reached.
+#
+# this only imports a few small builtin modules, so that running it is fast
+# enough for shell loops and cron jobs. keep it that way.
+USAGE = """usage: remind_client.py <command> [arguments...]
+
+commands:
+    add <time> <message> -- remind after an amount of time, e.g 'add 10m tea'
+    at <datetime> <message> -- remind at a date and/or time
+    every <interval> <message> -- remind every time an amount of time passes
+    ls [offset] [count] -- list active reminders
+    rm <IDs>|all|match <terms> -- remove active reminders by ID (e.g 'rm 3 5 9-20'), all of them or the ones /find <terms> lists
+    find <terms> -- list the reminders with words starting with <terms>
+    import <path> -- import reminders from a .csv, .jsonl or .ics file
+    export <path> -- export reminders to a .csv, .jsonl or .ics file
+    stats -- show metrics
+    watch -- print reminders as they go off, until interrupted
+    stop -- stop the daemon
+
+times with spaces in them have to be quoted, e.g 'add "1h 30m" tea'."""
+
+# commands whose argument is a path, which is made absolute before it's sent
+# since the daemon may run in a different directory
+PATH_COMMANDS = ("import", "export")
+
+def socketpath() -> str:
+    if os.getenv("REMIND_SOCKET"):
+        return os.getenv("REMIND_SOCKET")
+    if os.getenv("XDG_RUNTIME_DIR"):
+        return os.path.join(os.getenv("XDG_RUNTIME_DIR"), "remind.sock")
+    return f"/tmp/remind-{os.getuid()}.sock"
+
+def connect(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+# ----------------------------------------------------------------------------
+# the protocol: the client sends one JSON object, {"argv": [...]}, on one
+# line. the daemon answers with JSON objects, one per line: {"output": text}
+# for output, and {"status": n} once the command is done.
+
+# send a command to the daemon and print its output.
+#
+# returns the exit status.
+def request(argv: list) -> int:
+    try:
+        sock = connect(socketpath())
+    except OSError:
+        print(f"error: the remind daemon isn't running on {socketpath()} "
+              "(start it with 'python cli_frontend.py --daemon')", file=sys.stderr)
+        return 2
+    with sock, sock.makefile("rw", encoding="utf-8") as f:
+        f.write(json.dumps({"argv": argv}) + "\n")
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            if "output" in msg:
+                print(msg["output"], end="", flush=True)
+            if "status" in msg:
+                return msg["status"]
+    print("error: the daemon closed the connection", file=sys.stderr)
+    return 2
+
+def main() -> int:
+    argv = sys.argv[1:]
+    if not argv or argv[0] in ("-h", "--help", "help"):
+        print(USAGE)
+        return 0 if argv else 1
+    if argv[0] in PATH_COMMANDS and len(argv) > 1:
+        argv[1] = os.path.abspath(argv[1])
+    try:
+        return request(argv)
+    except KeyboardInterrupt:
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
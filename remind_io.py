@@ -0,0 +1,274 @@
+# ----------------------------------------------------------------------------
+# modules
+from datetime import datetime, timezone
+
+import csv
+import itertools
+import json
+
+# custom modules
+import remind
+
+# ----------------------------------------------------------------------------
+# import and export of reminders, used by the frontends' /import and /export
+# commands.
+#
+# three formats are supported:
+# - "csv": a header row and then rows with the columns type, when, message and
+#   optionally start.
+# - "jsonl": one JSON object per line with the same keys.
+# - "ics": iCalendar VEVENTs with a DTSTART, a SUMMARY and optionally a basic
+#   RRULE (FREQ and INTERVAL only).
+#
+# <type> is "after", "at" or "every", and <when> is a query for remindafter,
+# remindat or remindevery. <start> is the first fire of a repeating reminder
+# in the format of '%Y/%m/%d %H:%M:%S'; without it, it first fires one
+# interval after it was imported.
+#
+# both directions work on streams: files are read and parsed in chunks, and
+# exports are generated line by line, so big files are never held in memory
+# all at once.
+FORMATS = ("csv", "jsonl", "ics")
+
+DATETIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+# get the format of a file from its name.
+#
+# returns the format, or None if it isn't known.
+def fileformat(filename: str):
+    ext = filename.rsplit(".", 1)[-1].lower()
+    if ext in ("csv", "jsonl"):
+        return ext
+    elif ext in ("ics", "ical", "ifb", "icalendar"):
+        return "ics"
+    elif ext == "ndjson":
+        return "jsonl"
+    return None
+
+# ----------------------------------------------------------------------------
+# readers. each one turns lines of a file into (row number, type, when,
+# message, start) tuples, or (row number, error message) pairs for rows that
+# can't be read.
+
+def readcsv(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        try:
+            yield reader.line_num, row["type"], row["when"], row["message"], row.get("start") or None
+        except KeyError as e:
+            yield reader.line_num, f"missing column {e}"
+
+def readjsonl(lines):
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            yield lineno, row["type"], row["when"], row["message"], row.get("start")
+        except (ValueError, TypeError) as e:
+            yield lineno, f"invalid JSON: {e}"
+        except KeyError as e:
+            yield lineno, f"missing key {e}"
+
+# RRULE frequencies that map to a fixed interval, in seconds
+ICS_FREQS = {"SECONDLY": 1, "MINUTELY": 60, "HOURLY": 3600, "DAILY": 86400, "WEEKLY": 604800}
+
+# undo iCalendar line folding, where lines starting with a space or tab
+# continue the previous one.
+def unfold(lines):
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def icsunescape(text: str) -> str:
+    out = []
+    chars = iter(text)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, "")
+            out.append("\n" if c in ("n", "N") else c)
+        else:
+            out.append(c)
+    return "".join(out)
+
+def icsescape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+# parse a DATE or DATE-TIME value. UTC times are converted to local time, all
+# other times are taken as local time.
+def icsdatetime(value: str) -> datetime:
+    if "T" not in value:
+        return datetime.strptime(value, "%Y%m%d")
+    if value.endswith("Z"):
+        t = datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return t.astimezone().replace(tzinfo=None)
+    return datetime.strptime(value, "%Y%m%dT%H%M%S")
+
+# parse an RRULE into an interval in seconds. raises ValueError if it can't
+# be expressed as a fixed interval.
+def icsinterval(rrule: str) -> int:
+    parts = dict(part.split("=", 1) for part in rrule.split(";") if "=" in part)
+    freq = ICS_FREQS.get(parts.pop("FREQ", None))
+    interval = int(parts.pop("INTERVAL", "1"))
+    parts.pop("WKST", None)
+    if freq is None or parts or interval < 1:
+        raise ValueError("unsupported RRULE")
+    return freq * interval
+
+def readics(lines):
+    event = None
+    for lineno, line in enumerate(unfold(lines), 1):
+        name, _, value = line.partition(":")
+        name = name.split(";", 1)[0].upper()
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event = {"row": lineno}
+        elif event is None:
+            continue
+        elif name == "END" and value.upper() == "VEVENT":
+            try:
+                start = icsdatetime(event["DTSTART"])
+                message = icsunescape(event.get("SUMMARY", ""))
+                if "RRULE" in event:
+                    yield (event["row"], "every", f"{icsinterval(event['RRULE'])}s", message,
+                           start.strftime(DATETIME_FORMAT))
+                else:
+                    yield event["row"], "at", start.strftime(DATETIME_FORMAT), message, None
+            except KeyError:
+                yield event["row"], "missing DTSTART"
+            except ValueError as e:
+                yield event["row"], str(e)
+            event = None
+        elif name in ("DTSTART", "SUMMARY", "RRULE"):
+            event[name] = value
+
+READERS = {"csv": readcsv, "jsonl": readjsonl, "ics": readics}
+
+# check the fields of a row that was read. JSON values can be of any type,
+# and short CSV rows leave fields as None.
+#
+# returns an error message, or None if the row is fine.
+def checkrow(row: tuple):
+    _, kind, when, message, start = row
+    if kind not in ("after", "at", "every"):
+        return f"unknown reminder type '{kind}'"
+    elif not isinstance(when, str) or not when.strip():
+        return "'when' has to be a non-empty string"
+    elif not isinstance(message, str) or not message.strip():
+        return "'message' has to be a non-empty string"
+    elif start is not None and (not isinstance(start, str) or not start.strip()):
+        return "'start' has to be a non-empty string"
+    return None
+
+# ----------------------------------------------------------------------------
+# import reminders from the lines of a file in the format <fmt>, relative to
+# <now> (a datetime, or the current time if it's None).
+#
+# rows are read and parsed <chunk_size> at a time with remind.parse_many.
+# this is a generator that yields a (reminders, errors) pair per chunk: a
+# list of new Reminders to add to a store and schedule, and a list of
+# (row number, error message) pairs for the rows that couldn't be imported.
+def importreminders(lines, fmt: str, now: datetime = None, chunk_size: int = 1000):
+    if now is None:
+        now = datetime.now()
+    now_ts = now.timestamp()
+    rows = READERS[fmt](lines)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        rems, errors = [], []
+
+        # parse all queries of the same type in one go
+        bytype = {}
+        for row in chunk:
+            if len(row) == 2:
+                errors.append(row)
+            elif (error := checkrow(row)) is not None:
+                errors.append((row[0], error))
+            else:
+                bytype.setdefault(row[1], []).append(row)
+
+        for kind, typerows in bytype.items():
+            values, codes = remind.parse_many([row[2] for row in typerows], kind, now)
+            for row, value, code in zip(typerows, values, codes):
+                lineno, _, _, message, start = row
+                if code != remind.PARSE_OK:
+                    errors.append((lineno, remind.PARSE_MESSAGES[code]))
+                    continue
+                elif kind != "every":
+                    first, interval = value, None
+                elif value <= 0:
+                    errors.append((lineno, "interval cannot be zero"))
+                    continue
+                elif start:
+                    try:
+                        first = datetime.strptime(start, DATETIME_FORMAT).timestamp()
+                    except ValueError:
+                        errors.append((lineno, "invalid start time"))
+                        continue
+                    interval = value
+                else:
+                    first, interval = now_ts + value, value
+                # the frontends can't schedule, list or export reminders
+                # that datetime can't represent
+                if not 0 <= first <= remind.MAX_TIMESTAMP:
+                    errors.append((lineno, "date/time out of range"))
+                else:
+                    rems.append(remind.Reminder(message, first, interval))
+
+        errors.sort()
+        yield rems, errors
+
+# ----------------------------------------------------------------------------
+# export reminders (an iterable, e.g from ReminderStore.iter_owner) in the
+# format <fmt>. this is a generator that yields the file line by line.
+
+# get the (type, when, start) of a reminder as it is exported.
+def exportfields(rem: remind.Reminder) -> tuple:
+    first = datetime.fromtimestamp(rem.next_fire).strftime(DATETIME_FORMAT)
+    if rem.interval is None:
+        return "at", first, None
+    return "every", f"{int(rem.interval)}s", first
+
+class _LineWriter:
+    def write(self, line: str) -> str:
+        return line
+
+def exportreminders(rems, fmt: str):
+    if fmt == "csv":
+        writer = csv.writer(_LineWriter())
+        yield writer.writerow(["type", "when", "message", "start"])
+        for rem in rems:
+            kind, when, start = exportfields(rem)
+            yield writer.writerow([kind, when, rem.message, start or ""])
+    elif fmt == "jsonl":
+        for rem in rems:
+            kind, when, start = exportfields(rem)
+            row = {"type": kind, "when": when, "message": rem.message}
+            if start:
+                row["start"] = start
+            yield json.dumps(row) + "\n"
+    elif fmt == "ics":
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//remind//remind//EN\r\n"
+        for rem in rems:
+            lines = ["BEGIN:VEVENT",
+                     f"UID:{rem.job_id}-{rem.owner}@remind",
+                     f"DTSTAMP:{stamp}",
+                     "DTSTART:" + datetime.fromtimestamp(rem.next_fire).strftime("%Y%m%dT%H%M%S"),
+                     "SUMMARY:" + icsescape(rem.message)]
+            if rem.interval is not None:
+                lines.append(f"RRULE:FREQ=SECONDLY;INTERVAL={int(rem.interval)}")
+            lines.append("END:VEVENT")
+            yield "\r\n".join(lines) + "\r\n"
+        yield "END:VCALENDAR\r\n"
+    else:
+        raise ValueError(f"unknown format '{fmt}'")
@@ -0,0 +1,276 @@
+# ----------------------------------------------------------------------------
+# tests for remind.py. run with: python -m unittest
+
+# ----------------------------------------------------------------------------
+# modules
+from datetime import datetime
+
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+# custom modules
+import remind
+
+# ----------------------------------------------------------------------------
+# SQLiteReminderStore
+
+# the schema of the first version, before reply_to and jitter
+SCHEMA_V0 = """CREATE TABLE reminders (
+                   id INTEGER PRIMARY KEY,
+                   owner,
+                   type TEXT NOT NULL,
+                   message TEXT NOT NULL,
+                   timestr TEXT NOT NULL,
+                   next_fire REAL NOT NULL,
+                   interval REAL)"""
+
+# the schema of version 1, before jitter
+SCHEMA_V1 = """CREATE TABLE reminders (
+                   id INTEGER PRIMARY KEY,
+                   owner,
+                   reply_to INTEGER,
+                   message TEXT NOT NULL,
+                   next_fire REAL NOT NULL,
+                   interval REAL)"""
+
+class SQLiteReminderStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "remind.db")
+        self.store = None
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.close()
+        self.dir.cleanup()
+
+    # open the database, closing the store that was open before, if any
+    def open(self, **kwargs) -> remind.SQLiteReminderStore:
+        if self.store is not None:
+            self.store.close()
+        self.store = remind.SQLiteReminderStore(self.path, **kwargs)
+        return self.store
+
+    # reopen the database and load it
+    def reopen(self) -> remind.SQLiteReminderStore:
+        store = self.open()
+        store.load()
+        return store
+
+    def test_load(self):
+        store = self.open()
+        once = remind.Reminder("once", 2000000000.0, reply_to=7)
+        repeating = remind.Reminder("repeating", 2000000000.0, 60.0, jitter=1.5)
+        store.add(once, owner=1)
+        store.add(repeating, owner=2)
+        store = self.reopen()
+
+        self.assertEqual(len(store), 2)
+        self.assertIsNotNone(store.last_seen)
+        loaded = store.get(once.job_id)
+        self.assertEqual((loaded.owner, loaded.message, loaded.next_fire, loaded.interval, loaded.reply_to),
+                         (1, "once", 2000000000.0, None, 7))
+        loaded = store.get(repeating.job_id)
+        self.assertEqual((loaded.owner, loaded.interval, loaded.jitter), (2, 60.0, 1.5))
+        self.assertEqual([rem.message for rem in store.find(2, "rep")], ["repeating"])
+
+    def test_load_reuses_free_ids(self):
+        store = self.open()
+        rems = [remind.Reminder(str(i), 2000000000.0) for i in range(3)]
+        store.add_many(rems)
+        store.remove(rems[1].job_id)
+        store = self.reopen()
+
+        self.assertEqual(store.add(remind.Reminder("new", 2000000000.0)), rems[1].job_id)
+        self.assertEqual(store.add(remind.Reminder("newer", 2000000000.0)), 3)
+
+    def test_reuse_removed_id_before_flush(self):
+        store = self.open(batch_size=1000, flush_interval=3600)
+        old = remind.Reminder("old", 2000000000.0)
+        job_id = store.add(old)
+        store.flush()
+        store.remove(job_id)
+        new = remind.Reminder("new", 2000000000.0)
+        self.assertEqual(store.add(new), job_id)
+        store = self.reopen()
+
+        self.assertEqual([rem.message for rem in store], ["new"])
+
+    def test_remove_before_flush(self):
+        store = self.open(batch_size=1000, flush_interval=3600)
+        job_id = store.add(remind.Reminder("gone", 2000000000.0))
+        store.remove(job_id)
+        store = self.reopen()
+
+        self.assertEqual(len(store), 0)
+
+    def test_remove_many_flushes_once(self):
+        store = self.open(batch_size=2)
+        store.add_many([remind.Reminder(str(i), 2000000000.0) for i in range(10)])
+        flushes = []
+        flush = store.flush
+        store.flush = lambda: (flushes.append(None), flush())
+        store.remove_many(range(10))
+
+        self.assertEqual(len(flushes), 1)
+
+    def migrate(self, schema: str, rows: list, columns: str) -> remind.SQLiteReminderStore:
+        db = sqlite3.connect(self.path)
+        db.execute(schema)
+        db.executemany(f"INSERT INTO reminders ({columns}) VALUES ({', '.join('?' * len(rows[0]))})", rows)
+        db.commit()
+        db.close()
+        store = self.open()
+        store.load()
+        return store
+
+    def test_migrate_v0(self):
+        store = self.migrate(SCHEMA_V0, [(3, 1, "one-time", "hi", "at noon", 2000000000.0, None),
+                                         (5, 1, "repeating", "ho", "every 1 minutes", 2000000000.0, 60.0)],
+                             "id, owner, type, message, timestr, next_fire, interval")
+
+        self.assertEqual(sorted((rem.job_id, rem.message, rem.interval, rem.reply_to, rem.jitter) for rem in store),
+                         [(3, "hi", None, None, 0.0), (5, "ho", 60.0, None, 0.0)])
+        store = self.reopen()
+        version = sqlite3.connect(self.path).execute("PRAGMA user_version").fetchone()[0]
+        self.assertEqual(version, remind.SCHEMA_VERSION)
+        self.assertEqual(len(store), 2)
+
+    def test_migrate_v1(self):
+        store = self.migrate(SCHEMA_V1, [(2, 9, 4, "hi", 2000000000.0, None)],
+                             "id, owner, reply_to, message, next_fire, interval")
+
+        rem = store.get(2)
+        self.assertEqual((rem.owner, rem.reply_to, rem.message, rem.jitter), (9, 4, "hi", 0.0))
+
+# ----------------------------------------------------------------------------
+# ReminderScheduler
+
+class ReminderSchedulerTest(unittest.TestCase):
+    def test_pop_due(self):
+        scheduler = remind.ReminderScheduler()
+        fired = []
+        scheduler.add_job(fired.append, "date", args=["late"], run_date=200.0)
+        scheduler.add_job(fired.append, "date", args=["early"], run_date=100.0)
+        scheduler.add_job(fired.append, "date", args=["never"], run_date=300.0)
+
+        scheduler._run(scheduler._pop_due(250.0))
+        self.assertEqual(fired, ["early", "late"])
+        self.assertEqual(len(scheduler), 1)
+
+    def test_interval_fires_once_after_missed_fires(self):
+        scheduler = remind.ReminderScheduler()
+        timer = scheduler.add_job(lambda: None, "interval", seconds=10, next_run_time=100.0)
+
+        self.assertEqual(scheduler._pop_due(135.0), [timer])
+        self.assertEqual(timer.when, 140.0)
+        self.assertEqual(scheduler._pop_due(139.0), [])
+        self.assertEqual(len(scheduler), 1)
+
+    def test_cancel(self):
+        scheduler = remind.ReminderScheduler()
+        timer = scheduler.add_job(lambda: None, "date", run_date=100.0)
+        timer.remove()
+        timer.remove()
+
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler._pop_due(200.0), [])
+        self.assertIsNone(scheduler._next_wakeup())
+
+    def test_slack(self):
+        scheduler = remind.ReminderScheduler(slack=5.0)
+        scheduler.add_job(lambda: None, "date", run_date=101.0)
+
+        self.assertEqual(scheduler._next_wakeup(), 105.0)
+
+    def test_bad_trigger(self):
+        scheduler = remind.ReminderScheduler()
+        with self.assertRaises(ValueError):
+            scheduler.add_job(lambda: None, "cron")
+        with self.assertRaises(ValueError):
+            scheduler.add_job(lambda: None, "interval")
+
+    def test_thread_scheduler(self):
+        scheduler = remind.ThreadReminderScheduler()
+        fired = threading.Event()
+        scheduler.start()
+        self.addCleanup(scheduler.shutdown)
+        scheduler.add_job(fired.set, "date", run_date=time.time() + 0.05)
+
+        self.assertTrue(fired.wait(5))
+
+    def test_asyncio_scheduler(self):
+        async def run():
+            scheduler = remind.AsyncioReminderScheduler()
+            scheduler.start()
+            fired = asyncio.Event()
+
+            async def job():
+                fired.set()
+            scheduler.add_job(job, "date", run_date=time.time() + 0.05)
+            try:
+                await asyncio.wait_for(fired.wait(), 5)
+            finally:
+                scheduler.shutdown()
+        asyncio.run(run())
+
+# ----------------------------------------------------------------------------
+# parse_many
+
+class ParseManyTest(unittest.TestCase):
+    NOW = datetime(2030, 1, 1, 12, 0, 0)
+
+    def test_after(self):
+        values, errors = remind.parse_many(["10s", "1m 5s", "nope", ""], "after", self.NOW)
+        now = self.NOW.timestamp()
+
+        self.assertEqual(list(values), [now + 10, now + 65, 0.0, 0.0])
+        self.assertEqual(list(errors), [remind.PARSE_OK, remind.PARSE_OK,
+                                        remind.PARSE_INVALID_FORMAT, remind.PARSE_BAD_QUERY])
+
+    def test_at(self):
+        values, errors = remind.parse_many(["13:00:00", "11:00:00", "2030/01/02"], "at", self.NOW)
+
+        self.assertEqual(values[0], datetime(2030, 1, 1, 13, 0, 0).timestamp())
+        self.assertEqual(list(errors), [remind.PARSE_OK, remind.PARSE_IN_PAST, remind.PARSE_OK])
+
+    def test_every(self):
+        values, errors = remind.parse_many(["1h", "2 days"], "every", self.NOW)
+
+        self.assertEqual(list(values), [3600.0, 172800.0])
+        self.assertEqual(list(errors), [remind.PARSE_OK, remind.PARSE_OK])
+
+    def test_out_of_range(self):
+        for kind in ("after", "every"):
+            values, errors = remind.parse_many(["99999999999w", "1" * 400 + "s"], kind, self.NOW)
+            self.assertEqual(list(errors), [remind.PARSE_INVALID_FORMAT] * 2)
+
+    def test_matches_single_parsers(self):
+        queries = ["5m", "1h 30m", "2w", "5m"]
+        values, errors = remind.parse_many(queries, "after", self.NOW)
+
+        for query, value in zip(queries, values):
+            self.assertEqual(value, remind.remindafter(query, self.NOW).timestamp())
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            remind.parse_many(["10s"], "never")
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy isn't installed")
+        values, errors = remind.parse_many(["10s", "x"], "every", self.NOW, use_numpy=True)
+
+        self.assertIsInstance(values, numpy.ndarray)
+        self.assertEqual(values.tolist(), [10.0, 0.0])
+        self.assertEqual(errors.tolist(), [remind.PARSE_OK, remind.PARSE_INVALID_FORMAT])
+
+if __name__ == "__main__":
+    unittest.main()